@@ -0,0 +1,280 @@
+import os
+import math
+import time
+import heapq
+import random
+import hashlib
+import itertools
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from workers import share_of
+
+# Per-provider/per-key admission control.
+# Every outbound LLM or embeddings call takes a slot from the scheduler of the provider+key it
+# targets. Slots are handed out by priority (interactive chat first), gated by token-bucket
+# limits for requests and tokens, and callers are turned away fast once the queue is full.
+# Limits are for the whole server: with FREEGPT_WORKERS > 1 each worker process gets its share.
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_INGEST = 1
+PRIORITY_OCR = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_INGEST: "ingest",
+    PRIORITY_OCR: "ocr",
+}
+
+DEFAULT_RPM = int(os.getenv("FREEGPT_PROVIDER_RPM", "0"))  # 0 = unlimited
+DEFAULT_TPM = int(os.getenv("FREEGPT_PROVIDER_TPM", "0"))  # 0 = unlimited
+DEFAULT_CONCURRENCY = int(os.getenv("FREEGPT_PROVIDER_CONCURRENCY", "8"))
+DEFAULT_QUEUE_SIZE = int(os.getenv("FREEGPT_PROVIDER_QUEUE", "32"))
+ADMISSION_TIMEOUT = float(os.getenv("FREEGPT_ADMISSION_TIMEOUT", "120"))
+RATE_LIMIT_RETRIES = int(os.getenv("FREEGPT_PROVIDER_RETRIES", "3"))
+
+
+class AdmissionRejected(Exception):
+    """Raised when a provider queue is full or a slot could not be obtained in time."""
+
+    def __init__(self, provider: str, retry_after: int):
+        super().__init__(f"Provider '{provider}' is busy. Retry after {retry_after}s.")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+def estimate_tokens(text) -> int:
+    """Rough token estimate (~4 characters per token) used for token-bucket accounting."""
+    if not text:
+        return 0
+    if isinstance(text, (list, tuple)):
+        return sum(estimate_tokens(t) for t in text)
+    return max(1, len(str(text)) // 4)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status == 429:
+        return True
+    msg = str(error).lower()
+    return "429" in msg or "rate limit" in msg or "resource_exhausted" in msg or "too many requests" in msg
+
+
+def provider_for(model_name: str, api_key: str, base_url: str = None) -> str:
+    """Names the provider a model/key/base_url combination is sent to (mirrors RAGEngine._create_llm)."""
+    model = (model_name or "").lower()
+    if model.startswith("gemini"):
+        return "google"
+    if model.startswith("claude") and not base_url:
+        return "anthropic"
+    if base_url:
+        host = urlparse(base_url).hostname or base_url
+        return "openrouter" if "openrouter" in host else host
+    if api_key and api_key.startswith("sk-or-v1"):
+        return "openrouter"
+    return "openai"
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously; a per-minute rate of 0 disables it."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self):
+        return self.capacity <= 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        if self.unlimited:
+            return 0.0
+        now = time.monotonic()
+        self._refill(now)
+        # A single request larger than the bucket would wait forever; let it drain the bucket instead
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        if self.unlimited:
+            return
+        self._refill(time.monotonic())
+        self.tokens -= min(amount, self.capacity)
+
+    def drain(self):
+        """Empties the bucket, e.g. after the provider itself answered 429."""
+        if not self.unlimited:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0.0)
+
+
+class ProviderScheduler:
+    """Priority admission queue for a single provider+key."""
+
+    def __init__(self, name: str, rpm: int, tpm: int, max_concurrency: int, max_queue: int):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of (priority, seq)
+        self._waiting_by_priority = {p: 0 for p in PRIORITY_NAMES}
+        self._seq = itertools.count()
+        self._active = 0
+        self._avg_service = 1.0
+
+        self.admitted = 0
+        self.rejected = 0
+        self.provider_429s = 0
+        self.retries = 0
+
+    def _retry_after(self) -> int:
+        backlog = len(self._waiting) + self._active
+        estimate = (backlog / self.max_concurrency) * self._avg_service
+        estimate = max(estimate, self.requests.wait_time(1))
+        return max(1, int(math.ceil(estimate)))
+
+    def acquire(self, priority: int = PRIORITY_INTERACTIVE, tokens: int = 0, timeout: float = None):
+        timeout = ADMISSION_TIMEOUT if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            # Each priority class has its own bound so an OCR flood can't lock out chat
+            if self._waiting_by_priority[priority] >= self.max_queue:
+                self.rejected += 1
+                raise AdmissionRejected(self.name, self._retry_after())
+
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            self._waiting_by_priority[priority] += 1
+            try:
+                while True:
+                    wait = None
+                    if self._waiting[0] == ticket and self._active < self.max_concurrency:
+                        wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                        if wait <= 0:
+                            break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise AdmissionRejected(self.name, self._retry_after())
+                    self._cond.wait(remaining if wait is None else min(wait, remaining))
+
+                heapq.heappop(self._waiting)
+                self._waiting_by_priority[priority] -= 1
+                self.requests.consume(1)
+                self.tokens.consume(tokens)
+                self._active += 1
+                self.admitted += 1
+            except BaseException:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._waiting_by_priority[priority] -= 1
+                raise
+            finally:
+                self._cond.notify_all()
+
+    def release(self, elapsed: float = None):
+        with self._cond:
+            self._active -= 1
+            if elapsed is not None:
+                self._avg_service = 0.8 * self._avg_service + 0.2 * elapsed
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority: int = PRIORITY_INTERACTIVE, tokens: int = 0, timeout: float = None):
+        self.acquire(priority, tokens, timeout)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    def run(self, fn, priority: int = PRIORITY_INTERACTIVE, tokens: int = 0, retries: int = None):
+        """Runs fn inside a slot, backing off and retrying when the provider answers 429."""
+        retries = RATE_LIMIT_RETRIES if retries is None else retries
+        attempt = 0
+        while True:
+            with self.slot(priority, tokens):
+                try:
+                    return fn()
+                except Exception as e:
+                    if not is_rate_limit_error(e) or attempt >= retries:
+                        raise
+                    delay = self.rate_limited(attempt, retries)
+            time.sleep(delay)
+            attempt += 1
+
+    def rate_limited(self, attempt: int, retries: int) -> float:
+        """Records a provider 429 and returns how long to wait before retry number attempt + 1."""
+        # Everyone on this key backs off, not just this caller
+        with self._cond:
+            self.provider_429s += 1
+            self.retries += 1
+            self.requests.drain()
+            self.tokens.drain()
+        delay = (2 ** attempt) + random.uniform(0, 0.5)
+        print(f"DEBUG: Provider '{self.name}' rate limited. Retrying in {delay:.1f}s (attempt {attempt + 1}/{retries})")
+        return delay
+
+    def stats(self):
+        with self._cond:
+            return {
+                "active": self._active,
+                "max_concurrency": self.max_concurrency,
+                "queued": {PRIORITY_NAMES[p]: n for p, n in self._waiting_by_priority.items()},
+                "max_queue": self.max_queue,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "provider_429s": self.provider_429s,
+                "retries": self.retries,
+                "avg_service_seconds": round(self._avg_service, 3),
+            }
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def _provider_setting(provider: str, name: str, default: int) -> int:
+    env_name = "FREEGPT_" + "".join(c if c.isalnum() else "_" for c in provider.upper()) + "_" + name
+    return int(os.getenv(env_name, default))
+
+
+def get_scheduler(provider: str, api_key: str) -> ProviderScheduler:
+    """Returns the shared scheduler for a provider+key pair (keys are hashed, never stored)."""
+    key_hash = hashlib.sha256((api_key or "").encode()).hexdigest()[:12]
+    name = f"{provider}:{key_hash}"
+    scheduler = _schedulers.get(name)
+    if scheduler is None:
+        with _schedulers_lock:
+            scheduler = _schedulers.get(name)
+            if scheduler is None:
+                scheduler = ProviderScheduler(
+                    name,
+                    rpm=share_of(_provider_setting(provider, "RPM", DEFAULT_RPM)),
+                    tpm=share_of(_provider_setting(provider, "TPM", DEFAULT_TPM)),
+                    max_concurrency=share_of(_provider_setting(provider, "CONCURRENCY", DEFAULT_CONCURRENCY)),
+                    max_queue=_provider_setting(provider, "QUEUE", DEFAULT_QUEUE_SIZE),
+                )
+                _schedulers[name] = scheduler
+    return scheduler
+
+
+def scheduler_stats():
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return {s.name: s.stats() for s in schedulers}
@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dotenv import load_dotenv
+
+from extraction import SUPPORTED_EXTENSIONS, file_hash, iter_pages, iter_chunks
+
+# Bulk corpus ingestion.
+#   python bulk_ingest.py /path/to/share [--session-id ID] [--workers N] [--batch-size N]
+# Walks the tree, extracts text in a process pool, embeds chunks in batches and writes them into
+# the same store the server uses (run it from the server's working directory). Files whose content
+# hash is already in the store are skipped, and a JSONL checkpoint lets a killed run resume.
+
+DEFAULT_CHECKPOINT = "bulk_ingest_checkpoint.jsonl"
+
+_known_hashes = set()
+
+
+def _init_worker(known_hashes, verbose):
+    global _known_hashes
+    _known_hashes = known_hashes
+    if not verbose:
+        # Extraction prints a DEBUG line per step; with thousands of files that drowns the progress output
+        sys.stdout = open(os.devnull, "w")
+
+
+def extract_worker(path: str, source: str):
+    """Runs in a worker process: hash, skip if known, extract and chunk."""
+    result = {"path": path, "source": source, "hash": None, "pages": 0, "chunks": [], "skipped": False, "error": None}
+    try:
+        result["hash"] = file_hash(path)
+        if result["hash"] in _known_hashes:
+            result["skipped"] = True
+            return result
+        pages = set()
+
+        def counted(stream):
+            for page, text in stream:
+                pages.add(page)
+                yield page, text
+
+        result["chunks"] = list(iter_chunks(counted(iter_pages(path, source))))
+        # Unpaginated formats count as one page
+        result["pages"] = len(pages - {None}) or (1 if pages else 0)
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+class Checkpoint:
+    """Append-only log of files being written ('started') and fully committed ('done')."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = set()
+        started = set()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn last line from a kill
+                    (self.done if entry["status"] == "done" else started).add(entry["hash"])
+        self.partial = started - self.done
+        self._file = open(path, "a", encoding="utf-8")
+
+    def record(self, content_hash: str, source: str, status: str, chunks: int = 0):
+        self._file.write(json.dumps({"hash": content_hash, "source": source, "status": status, "chunks": chunks}) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class Progress:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.files = self.pages = self.chunks = self.skipped = self.failed = 0
+
+    def report(self, final: bool = False):
+        now = time.monotonic()
+        if not final and now - self.last_report < 5:
+            return
+        self.last_report = now
+        elapsed = max(now - self.start, 1e-6)
+        print(
+            f"{'Done' if final else 'Progress'}: {self.files} files, {self.pages} pages, {self.chunks} chunks "
+            f"({self.skipped} skipped, {self.failed} failed) in {elapsed:.0f}s | "
+            f"{self.files / elapsed:.1f} files/s, {self.pages / elapsed:.1f} pages/s, {self.chunks / elapsed:.1f} chunks/s",
+            flush=True
+        )
+
+
+def walk_files(root: Path, extensions):
+    for dirpath, _, filenames in os.walk(root):
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() in extensions:
+                path = Path(dirpath) / name
+                yield str(path), path.relative_to(root).as_posix()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-ingest a directory tree into the FreeGPT knowledge base")
+    parser.add_argument("directory")
+    parser.add_argument("--api-key", help="Defaults to GOOGLE_API_KEY / GEMINI_API_KEY / OPENAI_API_KEY")
+    parser.add_argument("--session-id", help="Attach the documents to a chat session instead of the global store")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="Extraction processes")
+    parser.add_argument("--batch-size", type=int, default=256, help="Chunks per embedding call")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--extensions", nargs="+", default=list(SUPPORTED_EXTENSIONS))
+    parser.add_argument("--ocr", action="store_true", help="OCR scanned PDFs with the LLM (slow, costs tokens)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    root_dir = Path(__file__).parent.parent
+    load_dotenv(root_dir / ".env")
+    load_dotenv(root_dir / ".env.local")
+    api_key = args.api_key or os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY") or os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        print("Error: No API key. Pass --api-key or set GOOGLE_API_KEY.")
+        return 1
+
+    # Imported here so worker processes don't load LangChain providers and the vector store
+    from rag_engine import RAGEngine
+    engine = RAGEngine(api_key=api_key)
+    if engine.vector_store is None:
+        print("Error: Vector store unavailable; see the messages above.")
+        return 1
+
+    checkpoint = Checkpoint(args.checkpoint)
+    for content_hash in checkpoint.partial:
+        # Killed mid-write last time: remove the half-written chunks, the file is redone below
+        engine.vector_store.delete({"content_hash": content_hash})
+    known = (engine.vector_store.content_hashes() | checkpoint.done) - checkpoint.partial
+    print(f"Ingesting {args.directory} with {args.workers} workers ({len(known)} documents already in the store).")
+
+    extensions = {e.lower() if e.startswith(".") else "." + e.lower() for e in args.extensions}
+    files = walk_files(Path(args.directory), extensions)
+    progress = Progress()
+    seen = set()
+    pending = []
+    pending_chunks = 0
+    needs_ocr = []
+
+    def flush():
+        nonlocal pending, pending_chunks
+        if not pending:
+            return
+        ids, texts, metadatas = [], [], []
+        for result in pending:
+            checkpoint.record(result["hash"], result["source"], "started")
+            for i, (chunk, page) in enumerate(result["chunks"]):
+                metadata = {"source": result["source"], "content_hash": result["hash"], "ingested_at": int(time.time())}
+                if args.session_id:
+                    metadata["session_id"] = args.session_id
+                if page is not None:
+                    metadata["page"] = page
+                ids.append(f"{result['hash']}:{i}")
+                texts.append(chunk)
+                metadatas.append(metadata)
+        for start in range(0, len(texts), args.batch_size):
+            end = start + args.batch_size
+            engine.add_chunks(ids[start:end], texts[start:end], metadatas[start:end], session_id=args.session_id)
+        for result in pending:
+            checkpoint.record(result["hash"], result["source"], "done", len(result["chunks"]))
+            progress.files += 1
+            progress.pages += result["pages"]
+            progress.chunks += len(result["chunks"])
+        pending = []
+        pending_chunks = 0
+
+    def handle(result):
+        nonlocal pending_chunks
+        if result["error"]:
+            progress.failed += 1
+            print(f"Failed: {result['source']}: {result['error']}")
+        elif result["skipped"] or result["hash"] in seen:
+            progress.skipped += 1
+        elif not result["chunks"]:
+            if args.ocr and result["source"].lower().endswith(".pdf"):
+                needs_ocr.append(result)
+            else:
+                progress.skipped += 1
+                print(f"No text: {result['source']}")
+        else:
+            pending.append(result)
+            pending_chunks += len(result["chunks"])
+        if result["hash"]:
+            seen.add(result["hash"])
+        if pending_chunks >= args.batch_size:
+            flush()
+        progress.report()
+
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(known, args.verbose)) as pool:
+            in_flight = set()
+            exhausted = False
+            while in_flight or not exhausted:
+                # Keep a bounded number of files queued so results never pile up in memory
+                while not exhausted and len(in_flight) < args.workers * 4:
+                    try:
+                        path, source = next(files)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    in_flight.add(pool.submit(extract_worker, path, source))
+                if not in_flight:
+                    break
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    handle(future.result())
+        flush()
+
+        for result in needs_ocr:
+            checkpoint.record(result["hash"], result["source"], "started")
+            count = engine.ingest_file(result["path"], result["source"], session_id=args.session_id)
+            checkpoint.record(result["hash"], result["source"], "done", count)
+            progress.files += 1
+            progress.pages += result["pages"]
+            progress.chunks += count
+            progress.report()
+    except KeyboardInterrupt:
+        print("Interrupted. Re-run the same command to resume.")
+        return 130
+    finally:
+        checkpoint.close()
+
+    progress.report(final=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,19 @@
-from sqlalchemy import create_engine, Column, String, Integer, Text, JSON
+from sqlalchemy import create_engine, event, Column, String, Integer, Float, Text, JSON
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 DATABASE_URL = "sqlite:///./chats.db"
 
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers in other worker processes continue while one writes; writers wait for each other instead of failing
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -16,6 +25,13 @@ class ChatSessionDB(Base):
     date_group = Column(String)  # e.g. "Today", "Yesterday"
     messages = Column(JSON)      # Store full message history as JSON
 
+class DeletedSessionDB(Base):
+    """A chat deleted from the history whose uploaded knowledge storage GC may still have to drop."""
+    __tablename__ = "deleted_sessions"
+
+    id = Column(String, primary_key=True, index=True)
+    deleted_at = Column(Float)
+
 def init_db():
     Base.metadata.create_all(bind=engine)
 
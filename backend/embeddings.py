@@ -0,0 +1,117 @@
+import os
+import threading
+
+from langchain_core.embeddings import Embeddings
+from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from langchain_openai import OpenAIEmbeddings
+from http_pool import get_http_client, get_async_http_client
+
+# Embedding provider selection.
+# FREEGPT_EMBEDDING_PROVIDER picks the provider explicitly (openai, google or local); 'auto'
+# keeps the old key-prefix guess but sends keys that can't embed (OpenRouter, Anthropic,
+# custom endpoints) to the local model instead of a provider that will reject them.
+# Every provider is identified by a model id ("openai:text-embedding-ada-002") that the
+# vector store records, so a collection is never queried with vectors from another model.
+
+EMBEDDING_PROVIDER = os.getenv("FREEGPT_EMBEDDING_PROVIDER", "auto").lower()
+EMBEDDING_API_KEY = os.getenv("FREEGPT_EMBEDDING_API_KEY")
+
+OPENAI_EMBEDDING_MODEL = os.getenv("FREEGPT_OPENAI_EMBEDDING_MODEL", "text-embedding-ada-002")
+GOOGLE_EMBEDDING_MODEL = os.getenv("FREEGPT_GOOGLE_EMBEDDING_MODEL", "models/embedding-001")
+LOCAL_EMBEDDING_MODEL = os.getenv("FREEGPT_LOCAL_EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5")
+LOCAL_EMBEDDING_THREADS = int(os.getenv("FREEGPT_LOCAL_EMBEDDING_THREADS", "0")) or None  # None = all cores
+LOCAL_EMBEDDING_BATCH = int(os.getenv("FREEGPT_LOCAL_EMBEDDING_BATCH", "64"))
+# Pre-populate this directory to run fully offline (the model is downloaded there on first use)
+LOCAL_EMBEDDING_CACHE = os.getenv("FREEGPT_LOCAL_EMBEDDING_CACHE", os.path.join(os.getcwd(), "models"))
+
+
+class EmbeddingModelMismatch(Exception):
+    """Raised when a store was built with a different embedding model than the one configured."""
+
+
+_local_models = {}
+_local_models_lock = threading.Lock()
+
+
+def _load_local_model(model_name: str):
+    """Loads an ONNX embedding model once per process; every engine shares it."""
+    with _local_models_lock:
+        model = _local_models.get(model_name)
+        if model is None:
+            try:
+                from fastembed import TextEmbedding
+            except ImportError:
+                raise ImportError("Local embeddings need the 'fastembed' package (pip install fastembed).")
+            print(f"DEBUG: Loading local embedding model {model_name}...")
+            model = TextEmbedding(model_name=model_name, threads=LOCAL_EMBEDDING_THREADS, cache_dir=LOCAL_EMBEDDING_CACHE)
+            _local_models[model_name] = model
+        return model
+
+
+class LocalEmbeddings(Embeddings):
+    """CPU embeddings through fastembed (ONNX runtime, batched, multi-threaded, works offline)."""
+
+    def __init__(self, model_name: str = LOCAL_EMBEDDING_MODEL, batch_size: int = LOCAL_EMBEDDING_BATCH):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = _load_local_model(model_name)
+
+    def embed_documents(self, texts):
+        return [vector.tolist() for vector in self.model.passage_embed(list(texts), batch_size=self.batch_size)]
+
+    def embed_query(self, text):
+        return next(iter(self.model.query_embed(text))).tolist()
+
+    def embed_queries(self, texts):
+        return [vector.tolist() for vector in self.model.query_embed(list(texts), batch_size=self.batch_size)]
+
+
+def embed_queries(embeddings, queries):
+    """Embeds many search queries in as few provider calls as possible, query-side where providers distinguish."""
+    if isinstance(embeddings, LocalEmbeddings):
+        return embeddings.embed_queries(queries)
+    if isinstance(embeddings, GoogleGenerativeAIEmbeddings):
+        return embeddings.embed_documents(list(queries), task_type="RETRIEVAL_QUERY")
+    # OpenAI embeds queries and documents alike
+    return embeddings.embed_documents(list(queries))
+
+
+def resolve_provider(api_key: str, base_url: str = None, provider: str = EMBEDDING_PROVIDER) -> str:
+    if provider != "auto":
+        return provider
+    if api_key.startswith("sk-or-") or api_key.startswith("sk-ant-") or (api_key.startswith("sk-") and base_url):
+        # OpenRouter, Anthropic and custom endpoints have no compatible embeddings API
+        return "local"
+    if api_key.startswith("sk-"):
+        return "openai"
+    return "google"
+
+
+def create_embeddings(api_key: str, base_url: str = None, provider: str = EMBEDDING_PROVIDER):
+    """Returns (embeddings, provider, model_id) for the configured or detected provider."""
+    provider = resolve_provider(api_key, base_url, provider)
+    key = EMBEDDING_API_KEY or api_key
+
+    if provider == "openai":
+        print("DEBUG: Using OpenAIEmbeddings")
+        embeddings = OpenAIEmbeddings(
+            model=OPENAI_EMBEDDING_MODEL,
+            api_key=key,
+            http_client=get_http_client(),
+            http_async_client=get_async_http_client()
+        )
+        return embeddings, provider, f"openai:{OPENAI_EMBEDDING_MODEL}"
+
+    if provider == "google":
+        print("DEBUG: Using GoogleGenerativeAIEmbeddings")
+        embeddings = GoogleGenerativeAIEmbeddings(
+            model=GOOGLE_EMBEDDING_MODEL,
+            google_api_key=key
+        )
+        return embeddings, provider, f"google:{GOOGLE_EMBEDDING_MODEL}"
+
+    if provider == "local":
+        print(f"DEBUG: Using local embeddings ({LOCAL_EMBEDDING_MODEL})")
+        return LocalEmbeddings(), provider, f"local:{LOCAL_EMBEDDING_MODEL}"
+
+    raise ValueError(f"Unknown embedding provider '{provider}'. Use openai, google, local or auto.")
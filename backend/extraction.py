@@ -0,0 +1,251 @@
+import os
+import hashlib
+import pypdf
+import docx
+import fitz # pymupdf
+import pdfplumber
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# Text extraction shared by RAGEngine.ingest_file and the bulk ingester.
+# Kept free of engine/LLM state so it can run in worker processes; OCR stays in RAGEngine.
+# Everything is a generator: pages stream out of the file and into iter_chunks, so a
+# document is never held as one string and memory stays flat however long it is.
+
+SUPPORTED_EXTENSIONS = (".pdf", ".docx", ".txt")
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# Plain text and DOCX have no pages; they are streamed in blocks of about this many characters
+BLOCK_SIZE = 64 * 1024
+
+
+def file_hash(file_path: str) -> str:
+    """SHA-256 of the file contents, used to skip documents that were already ingested."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_supported(source: str) -> bool:
+    return os.path.splitext(source)[1].lower() in SUPPORTED_EXTENSIONS
+
+
+def _pypdf_pages(file_path: str):
+    reader = pypdf.PdfReader(file_path)
+    for number, page in enumerate(reader.pages, start=1):
+        yield number, page.extract_text()
+
+
+def _fitz_pages(file_path: str):
+    doc = fitz.open(file_path)
+    try:
+        for number, page in enumerate(doc, start=1):
+            yield number, page.get_text()
+    finally:
+        doc.close()
+
+
+def _pdfplumber_pages(file_path: str):
+    with pdfplumber.open(file_path) as pdf:
+        for number, page in enumerate(pdf.pages, start=1):
+            yield number, page.extract_text()
+            page.flush_cache()  # pdfplumber keeps parsed layout objects per page otherwise
+
+
+# Default order; pdf_profiler learns a better first choice per producer
+PDF_EXTRACTORS = {
+    "pypdf": _pypdf_pages,
+    "PyMuPDF": _fitz_pages,
+    "pdfplumber": _pdfplumber_pages,
+}
+
+
+def iter_pdf_pages(file_path: str, strategy: str = None):
+    """Yields (page_number, text) using the learned strategy first, then the remaining extractors.
+
+    A reader is only replaced by the next one if it produced no text at all, so pages are
+    never yielded twice. Without an explicit strategy the one learned for this PDF's producer is used.
+    """
+    if strategy is None:
+        # Imported here because pdf_profiler builds on this module
+        from pdf_profiler import choose_strategy
+        strategy = choose_strategy(file_path)
+
+    if strategy == "ocr":
+        # Known scan family: only the fastest reader checks for a text layer before OCR
+        names = ["PyMuPDF"]
+    else:
+        names = list(PDF_EXTRACTORS)
+        if strategy in PDF_EXTRACTORS:
+            names.remove(strategy)
+            names.insert(0, strategy)
+
+    for name in names:
+        print(f"DEBUG: Processing PDF with {name}...")
+        produced = False
+        try:
+            for number, text in PDF_EXTRACTORS[name](file_path):
+                if text and text.strip():
+                    produced = True
+                    yield number, text + "\n"
+        except Exception as e:
+            print(f"DEBUG: {name} failed: {e}")
+        if produced:
+            return
+        print(f"DEBUG: {name} yielded empty text.")
+
+
+def _iter_blocks(lines):
+    block = []
+    size = 0
+    for line in lines:
+        block.append(line)
+        size += len(line)
+        if size >= BLOCK_SIZE:
+            yield None, "".join(block)
+            block = []
+            size = 0
+    if block:
+        yield None, "".join(block)
+
+
+def iter_pages(file_path: str, source: str = None):
+    """Yields (page_number, text) for a supported file; page_number is None for unpaginated formats."""
+    ext = os.path.splitext(source or file_path)[1].lower()
+
+    if ext == ".pdf":
+        yield from iter_pdf_pages(file_path)
+    elif ext == ".docx":
+        print("DEBUG: Processing DOCX...")
+        doc = docx.Document(file_path)
+        yield from _iter_blocks(para.text + "\n" for para in doc.paragraphs)
+    elif ext == ".txt":
+        print("DEBUG: Processing TXT...")
+        with open(file_path, "r", encoding="utf-8") as f:
+            yield from _iter_blocks(f)
+    else:
+        print(f"DEBUG: Unsupported file extension: {ext}")
+
+
+class _SplitLevel:
+    """RecursiveCharacterTextSplitter._split_text for one separator, fed text a piece at a time.
+
+    The splitter cuts the text at its first separator, merges the short pieces greedily (with
+    overlap) and recurses into pieces of chunk_size or more with the next separators. Choosing the
+    first separator that occurs in the text, as split_text does, gives the same chunks as always
+    using the first one, so each level can decide without seeing the rest of the document. A chunk
+    is released as soon as no later text can change it; a long piece is streamed into the next
+    level instead of being buffered.
+    """
+
+    def __init__(self, splitter, separators):
+        self.size = splitter._chunk_size
+        self.overlap = splitter._chunk_overlap
+        self.splitter = splitter
+        self.separator = separators[0]
+        self.separators = separators[1:]
+        self.piece = ""    # text of the current piece not yet handed to the child
+        self.lead = 0      # length of the separator the piece starts with
+        self.child = None  # next level, once the current piece is known to be long
+        self.current = []  # pieces of the chunk being merged
+        self.total = 0
+
+    def _merge(self, piece):
+        # _merge_splits with keep_separator's empty join separator, one piece at a time
+        if self.total + len(piece) > self.size and self.current:
+            doc = self.splitter._join_docs(self.current, "")
+            if doc is not None:
+                yield doc
+            while self.total > self.overlap or (self.total + len(piece) > self.size and self.total > 0):
+                self.total -= len(self.current.pop(0))
+        self.current.append(piece)
+        self.total += len(piece)
+
+    def _flush(self):
+        doc = self.splitter._join_docs(self.current, "") if self.current else None
+        self.current, self.total = [], 0
+        if doc is not None:
+            yield doc
+
+    def _open_child(self):
+        yield from self._flush()
+        self.child = _SplitLevel(self.splitter, self.separators)
+
+    def _end_piece(self, piece):
+        if self.child is None and len(piece) >= self.size:
+            yield from self._open_child()
+        if self.child is not None:
+            yield from self.child.feed(piece)
+            yield from self.child.finish()
+            self.child = None
+        elif piece:
+            yield from self._merge(piece)
+
+    def feed(self, text):
+        if not self.separator:
+            for char in text:
+                yield from self._merge(char)
+            return
+        self.piece += text
+        while True:
+            found = self.piece.find(self.separator, self.lead)
+            if found < 0:
+                break
+            piece, self.piece, self.lead = self.piece[:found], self.piece[found:], len(self.separator)
+            yield from self._end_piece(piece)
+
+        if self.child is None and len(self.piece) >= self.size:
+            yield from self._open_child()
+        if self.child is not None:
+            # Hand over everything that cannot be the start of the next separator
+            keep = max(self.lead, len(self.piece) - len(self.separator) + 1)
+            if keep:
+                yield from self.child.feed(self.piece[:keep])
+                self.piece, self.lead = self.piece[keep:], 0
+
+    def finish(self):
+        if self.separator:
+            piece, self.piece, self.lead = self.piece, "", 0
+            yield from self._end_piece(piece)
+        yield from self._flush()
+
+
+def iter_chunks(pages, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
+    """Incremental splitter: turns a stream of (page_number, text) into (chunk, page_number).
+
+    Yields exactly the chunks RecursiveCharacterTextSplitter.split_text gives for the whole
+    document, while buffering only a few chunks' worth of text. The page reported is the one
+    the chunk starts on.
+    """
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    level = _SplitLevel(splitter, splitter._separators)
+    window = ""      # text from the start of the last chunk on, to locate the next chunks
+    window_start = 0  # document offset of window[0]
+    cursor = 0        # search position in window
+    marks = []        # (document offset, page_number) where each page starts
+
+    def located(chunks):
+        nonlocal window, window_start, cursor
+        for chunk in chunks:
+            offset = window.find(chunk, cursor)
+            if offset < 0:
+                offset = cursor
+            start = window_start + offset
+            page = None
+            for mark_start, number in marks:
+                if mark_start > start:
+                    break
+                page = number
+            yield chunk, page
+            window, window_start, cursor = window[offset:], start, 1
+            while len(marks) > 1 and marks[1][0] <= start:
+                marks.pop(0)
+
+    for number, text in pages:
+        if not text:
+            continue
+        marks.append((window_start + len(window), number))
+        window += text
+        yield from located(level.feed(text))
+    yield from located(level.finish())
@@ -0,0 +1,317 @@
+import os
+import json
+import time
+import queue
+import threading
+from collections import deque
+
+from admission import AdmissionRejected, RATE_LIMIT_RETRIES, is_rate_limit_error
+from http_pool import abort_response, track_responses
+
+# Hedged requests and latency-based failover across a chain of providers.
+# The primary is called first; if it hasn't produced a first token within HEDGE_DELAY the next
+# provider in the chain is raced against it. Whichever streams first wins, the others are cancelled.
+# Providers whose recent p95 first-token latency or error rate is bad are moved to the back of the chain.
+
+HEDGE_DELAY = float(os.getenv("FREEGPT_HEDGE_DELAY", "4"))
+HEALTH_WINDOW = int(os.getenv("FREEGPT_HEALTH_WINDOW", "50"))
+HEALTH_MIN_SAMPLES = int(os.getenv("FREEGPT_HEALTH_MIN_SAMPLES", "5"))
+UNHEALTHY_P95 = float(os.getenv("FREEGPT_UNHEALTHY_P95", "20"))
+UNHEALTHY_ERROR_RATE = float(os.getenv("FREEGPT_UNHEALTHY_ERROR_RATE", "0.5"))
+
+
+def load_fallback_chains():
+    """Parses FREEGPT_FALLBACK_CHAINS.
+
+    Format (JSON): {"gpt-4o": [{"model": "openai/gpt-4o", "base_url": "https://openrouter.ai/api/v1",
+    "api_key_env": "OPENROUTER_API_KEY"}, {"model": "gemini-1.5-pro", "api_key_env": "GOOGLE_API_KEY"}]}
+    A "*" entry applies to every model without its own chain.
+    """
+    raw = os.getenv("FREEGPT_FALLBACK_CHAINS")
+    if not raw:
+        return {}
+    try:
+        chains = json.loads(raw)
+    except json.JSONDecodeError as e:
+        print(f"Warning: FREEGPT_FALLBACK_CHAINS is not valid JSON: {e}")
+        return {}
+    return chains if isinstance(chains, dict) else {}
+
+
+FALLBACK_CHAINS = load_fallback_chains()
+
+
+def fallbacks_for(model_name: str):
+    """Returns (model, api_key, base_url) tuples configured as fallbacks for a model."""
+    entries = FALLBACK_CHAINS.get(model_name, FALLBACK_CHAINS.get("*", []))
+    fallbacks = []
+    for entry in entries:
+        if entry.get("model") == model_name:
+            continue
+        api_key = os.getenv(entry.get("api_key_env", "")) if entry.get("api_key_env") else None
+        if not api_key:
+            print(f"DEBUG: Skipping fallback '{entry.get('model')}' - no API key in {entry.get('api_key_env')}")
+            continue
+        fallbacks.append((entry["model"], api_key, entry.get("base_url")))
+    return fallbacks
+
+
+class ProviderHealth:
+    """Sliding window of first-token latencies and errors for one provider/model."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._samples = deque(maxlen=HEALTH_WINDOW)  # (latency or None, ok)
+        self._lock = threading.Lock()
+        self.hedges_won = 0
+
+    def record_success(self, latency: float):
+        with self._lock:
+            self._samples.append((latency, True))
+
+    def record_error(self):
+        with self._lock:
+            self._samples.append((None, False))
+
+    def record_slow(self, latency: float):
+        """A call cancelled before its first token; its latency is at least this long."""
+        with self._lock:
+            self._samples.append((latency, True))
+
+    def p95(self):
+        with self._lock:
+            latencies = sorted(l for l, _ in self._samples if l is not None)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def error_rate(self):
+        with self._lock:
+            if not self._samples:
+                return 0.0
+            return sum(1 for _, ok in self._samples if not ok) / len(self._samples)
+
+    def healthy(self) -> bool:
+        with self._lock:
+            if len(self._samples) < HEALTH_MIN_SAMPLES:
+                return True
+        p95 = self.p95()
+        return self.error_rate() < UNHEALTHY_ERROR_RATE and (p95 is None or p95 < UNHEALTHY_P95)
+
+    def stats(self):
+        with self._lock:
+            samples = len(self._samples)
+        p95 = self.p95()
+        return {
+            "samples": samples,
+            "p95_first_token_seconds": round(p95, 3) if p95 is not None else None,
+            "error_rate": round(self.error_rate(), 3),
+            "healthy": self.healthy(),
+            "hedges_won": self.hedges_won,
+        }
+
+
+_health = {}
+_health_lock = threading.Lock()
+
+
+def get_health(name: str) -> ProviderHealth:
+    with _health_lock:
+        if name not in _health:
+            _health[name] = ProviderHealth(name)
+        return _health[name]
+
+
+def health_stats():
+    with _health_lock:
+        entries = list(_health.values())
+    return {h.name: h.stats() for h in entries}
+
+
+class Candidate:
+    """One provider/model in a fallback chain."""
+
+    def __init__(self, name: str, llm, scheduler):
+        self.name = name
+        self.llm = llm
+        self.scheduler = scheduler
+        self.health = get_health(name)
+
+
+def order_candidates(candidates):
+    """Keeps configured order but routes around unhealthy providers (they stay as last resort)."""
+    healthy = [c for c in candidates if c.health.healthy()]
+    unhealthy = [c for c in candidates if not c.health.healthy()]
+    if unhealthy:
+        print(f"DEBUG: Routing around unhealthy providers: {[c.name for c in unhealthy]}")
+    return healthy + unhealthy
+
+
+class _Attempt:
+    """One candidate's call, cancellable from the coordinating thread.
+
+    cancel() gives the admission slot back at once and aborts the HTTP response the call is
+    reading, so a losing hedge neither holds capacity nor keeps streaming until its next chunk.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._admitted_at = None
+        self._responses = []
+
+    def admit(self, priority: int, tokens: int) -> bool:
+        self.scheduler.acquire(priority, tokens)
+        with self._lock:
+            self._admitted_at = time.monotonic()
+        if self.cancelled.is_set():
+            self.release()
+            return False
+        return True
+
+    def release(self):
+        with self._lock:
+            admitted_at, self._admitted_at = self._admitted_at, None
+            self._responses = []
+        if admitted_at is not None:
+            self.scheduler.release(time.monotonic() - admitted_at)
+
+    def track(self, response):
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._responses.append(response)
+                return
+        abort_response(response)
+
+    def cancel(self):
+        self.cancelled.set()
+        with self._lock:
+            responses = list(self._responses)
+        for response in responses:
+            abort_response(response)
+        self.release()
+
+
+def _stream_candidate(index, candidate, messages, priority, tokens, attempt, events):
+    retry = 0
+    while True:
+        result = None
+        start = time.monotonic()
+        try:
+            if not attempt.admit(priority, tokens):
+                return
+            try:
+                start = time.monotonic()
+                with track_responses(attempt.track):
+                    stream = candidate.llm.stream(messages)
+                    try:
+                        for chunk in stream:
+                            if attempt.cancelled.is_set():
+                                break
+                            if result is None:
+                                events.put(("first", index, time.monotonic() - start))
+                                result = chunk
+                            else:
+                                result = result + chunk
+                    finally:
+                        close = getattr(stream, "close", None)
+                        if close:
+                            close()
+            finally:
+                attempt.release()
+        except AdmissionRejected as e:
+            events.put(("rejected", index, e))
+            return
+        except Exception as e:
+            if not attempt.cancelled.is_set():
+                # Same 429 back-off as ProviderScheduler.run, as long as nothing was streamed yet
+                if result is None and is_rate_limit_error(e) and retry < RATE_LIMIT_RETRIES:
+                    delay = candidate.scheduler.rate_limited(retry, RATE_LIMIT_RETRIES)
+                    retry += 1
+                    if not attempt.cancelled.wait(delay):
+                        continue
+                else:
+                    events.put(("error", index, e))
+                    return
+        if attempt.cancelled.is_set():
+            # Aborted by the coordinator; its latency is at least this long
+            if result is None:
+                candidate.health.record_slow(time.monotonic() - start)
+            return
+        events.put(("done", index, result))
+        return
+
+
+def hedged_invoke(candidates, messages, priority: int, tokens: int = 0, hedge_delay: float = None):
+    """Streams from the first candidate and hedges to the next ones when no first token arrives in time."""
+    hedge_delay = HEDGE_DELAY if hedge_delay is None else hedge_delay
+    candidates = order_candidates(candidates)
+    events = queue.Queue()
+    attempts = []
+    in_flight = set()
+    winner = None
+    last_error = None
+    rejections = []
+
+    def launch():
+        index = len(attempts)
+        attempt = _Attempt(candidates[index].scheduler)
+        attempts.append(attempt)
+        in_flight.add(index)
+        if index > 0:
+            print(f"DEBUG: Hedging request to '{candidates[index].name}'")
+        threading.Thread(
+            target=_stream_candidate,
+            args=(index, candidates[index], messages, priority, tokens, attempt, events),
+            name=f"hedge-{index}",
+            daemon=True,
+        ).start()
+
+    launch()
+    while True:
+        can_hedge = winner is None and len(attempts) < len(candidates)
+        try:
+            kind, index, payload = events.get(timeout=hedge_delay if can_hedge else None)
+        except queue.Empty:
+            launch()
+            continue
+
+        if kind == "first":
+            candidates[index].health.record_success(payload)
+            if winner is None:
+                winner = index
+                if index > 0:
+                    candidates[index].health.hedges_won += 1
+                for other, attempt in enumerate(attempts):
+                    if other != index:
+                        attempt.cancel()
+        elif kind == "done":
+            in_flight.discard(index)
+            if winner is None or index == winner:
+                if payload is None:
+                    last_error = RuntimeError(f"'{candidates[index].name}' returned an empty response")
+                else:
+                    return payload
+        elif kind == "rejected":
+            # Our own admission queue is full; not the provider's fault
+            in_flight.discard(index)
+            rejections.append(payload)
+            print(f"DEBUG: Provider '{candidates[index].name}' not admitted: {payload}")
+        elif kind == "error":
+            in_flight.discard(index)
+            last_error = payload
+            candidates[index].health.record_error()
+            print(f"DEBUG: Provider '{candidates[index].name}' failed: {payload}")
+            if index == winner:
+                # Died mid-stream; the others were cancelled, so fall through to the next candidate
+                winner = None
+
+        if winner is None and not (in_flight - {i for i, a in enumerate(attempts) if a.cancelled.is_set()}):
+            if len(attempts) < len(candidates):
+                launch()
+            elif last_error is None and rejections:
+                # Every candidate was turned away at admission: a 429, like the non-hedged path
+                raise min(rejections, key=lambda e: e.retry_after)
+            else:
+                raise last_error
@@ -0,0 +1,192 @@
+import os
+import socket
+import threading
+import importlib.util
+from collections import Counter
+from contextlib import contextmanager
+
+import httpx
+
+# Process-wide HTTP connection pool shared by every provider client and the search tool.
+# Recreating a ChatOpenAI/OpenAIEmbeddings instance no longer throws away warm connections.
+
+MAX_CONNECTIONS = int(os.getenv("FREEGPT_HTTP_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE = int(os.getenv("FREEGPT_HTTP_MAX_KEEPALIVE", "20"))
+KEEPALIVE_EXPIRY = float(os.getenv("FREEGPT_HTTP_KEEPALIVE_EXPIRY", "60"))
+REQUEST_TIMEOUT = float(os.getenv("FREEGPT_HTTP_TIMEOUT", "60"))
+CONNECT_TIMEOUT = float(os.getenv("FREEGPT_HTTP_CONNECT_TIMEOUT", "10"))
+
+# HTTP/2 needs the optional 'h2' package (pip install httpx[http2])
+HTTP2 = (
+    os.getenv("FREEGPT_HTTP2", "true").lower() in ("1", "true", "yes")
+    and importlib.util.find_spec("h2") is not None
+)
+
+_lock = threading.Lock()
+_sync_client = None
+_async_client = None
+
+_stats_lock = threading.Lock()
+_requests_by_host = Counter()
+_errors_by_host = Counter()
+_http_versions = Counter()
+
+# Per-thread hook that sees each response of the shared sync client (see track_responses)
+_local = threading.local()
+
+
+def _limits():
+    return httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def _timeout():
+    return httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+
+def _record_request(request):
+    with _stats_lock:
+        _requests_by_host[request.url.host] += 1
+
+
+def _record_response(response):
+    with _stats_lock:
+        _http_versions[response.http_version] += 1
+        if response.status_code >= 400:
+            _errors_by_host[response.request.url.host] += 1
+    on_response = getattr(_local, "on_response", None)
+    if on_response is not None:
+        on_response(response)
+
+
+async def _arecord_request(request):
+    _record_request(request)
+
+
+async def _arecord_response(response):
+    _record_response(response)
+
+
+def get_http_client() -> httpx.Client:
+    """Returns the shared synchronous HTTP client."""
+    global _sync_client
+    if _sync_client is None:
+        with _lock:
+            if _sync_client is None:
+                print(f"DEBUG: Creating shared HTTP pool (max={MAX_CONNECTIONS}, keepalive={MAX_KEEPALIVE}, http2={HTTP2})")
+                _sync_client = httpx.Client(
+                    http2=HTTP2,
+                    limits=_limits(),
+                    timeout=_timeout(),
+                    event_hooks={"request": [_record_request], "response": [_record_response]},
+                )
+    return _sync_client
+
+
+@contextmanager
+def track_responses(callback):
+    """Calls callback(response) for each response the shared sync client receives on this thread."""
+    previous = getattr(_local, "on_response", None)
+    _local.on_response = callback
+    try:
+        yield
+    finally:
+        _local.on_response = previous
+
+
+def abort_response(response) -> bool:
+    """Interrupts a response that another thread is still reading by shutting its socket down.
+
+    Only HTTP/1.1: an HTTP/2 connection carries other requests too, so those are left alone.
+    """
+    if response.http_version != "HTTP/1.1":
+        return False
+    stream = response.extensions.get("network_stream")
+    sock = stream.get_extra_info("socket") if stream is not None else None
+    if sock is None:
+        return False
+    try:
+        # Plain socket shutdown, also for TLS: the reader gets an error instead of blocking
+        socket.socket.shutdown(sock, socket.SHUT_RDWR)
+    except OSError:
+        return False
+    return True
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Returns the shared asynchronous HTTP client."""
+    global _async_client
+    if _async_client is None:
+        with _lock:
+            if _async_client is None:
+                _async_client = httpx.AsyncClient(
+                    http2=HTTP2,
+                    limits=_limits(),
+                    timeout=_timeout(),
+                    event_hooks={"request": [_arecord_request], "response": [_arecord_response]},
+                )
+    return _async_client
+
+
+def _pool_connections(client):
+    """Best-effort peek at the httpcore pool behind a client."""
+    if client is None:
+        return []
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    return list(getattr(pool, "connections", []) or [])
+
+
+def _describe_connections(connections):
+    hosts = Counter()
+    idle = 0
+    for conn in connections:
+        origin = getattr(conn, "_origin", None)
+        if origin is not None:
+            hosts[origin.host.decode("ascii", "ignore")] += 1
+        try:
+            if conn.is_idle():
+                idle += 1
+        except Exception:
+            pass
+    return {"open": len(connections), "idle": idle, "by_host": dict(hosts)}
+
+
+def pool_stats():
+    """Returns connection pool usage statistics."""
+    with _stats_lock:
+        requests_by_host = dict(_requests_by_host)
+        errors_by_host = dict(_errors_by_host)
+        http_versions = dict(_http_versions)
+
+    return {
+        "config": {
+            "max_connections": MAX_CONNECTIONS,
+            "max_keepalive": MAX_KEEPALIVE,
+            "keepalive_expiry": KEEPALIVE_EXPIRY,
+            "timeout": REQUEST_TIMEOUT,
+            "connect_timeout": CONNECT_TIMEOUT,
+            "http2": HTTP2,
+        },
+        "requests_total": sum(requests_by_host.values()),
+        "requests_by_host": requests_by_host,
+        "errors_by_host": errors_by_host,
+        "http_versions": http_versions,
+        "sync_connections": _describe_connections(_pool_connections(_sync_client)),
+        "async_connections": _describe_connections(_pool_connections(_async_client)),
+    }
+
+
+async def close_pools():
+    """Closes the shared clients (called on application shutdown)."""
+    global _sync_client, _async_client
+    with _lock:
+        sync_client, async_client = _sync_client, _async_client
+        _sync_client = None
+        _async_client = None
+    if sync_client is not None:
+        sync_client.close()
+    if async_client is not None:
+        await async_client.aclose()
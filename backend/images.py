@@ -0,0 +1,202 @@
+import os
+import io
+import math
+import base64
+import threading
+import fitz # pymupdf
+
+# Image preparation for vision calls.
+# Chat images are decoded, downscaled to the resolution the target model actually uses (anything
+# larger is resized by the provider anyway and only costs upload time and memory) and recompressed.
+# OCR pages are rendered at a DPI that fits the same budget, in grayscale JPEG instead of RGB PNG.
+# Pillow is needed for chat images; without it they are passed through unchanged.
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Overrides the per-model longest-edge target for every model
+IMAGE_MAX_EDGE = int(os.getenv("FREEGPT_IMAGE_MAX_EDGE", "0"))
+IMAGE_QUALITY = int(os.getenv("FREEGPT_IMAGE_QUALITY", "85"))
+IMAGE_MAX_BYTES = int(os.getenv("FREEGPT_IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+OCR_MIN_DPI = int(os.getenv("FREEGPT_OCR_MIN_DPI", "100"))
+OCR_MAX_DPI = int(os.getenv("FREEGPT_OCR_MAX_DPI", "200"))
+OCR_QUALITY = int(os.getenv("FREEGPT_OCR_QUALITY", "75"))
+
+
+class ImageTooLarge(Exception):
+    """Raised when an uploaded image exceeds FREEGPT_IMAGE_MAX_BYTES."""
+
+
+class InvalidImage(ValueError):
+    """Raised when an image data URL cannot be decoded."""
+
+
+def image_limits(model: str = None):
+    """(longest edge, shortest edge) in pixels beyond which the model gains nothing."""
+    name = (model or "").lower()
+    if IMAGE_MAX_EDGE:
+        return IMAGE_MAX_EDGE, IMAGE_MAX_EDGE
+    if "claude" in name:
+        return 1568, 1568
+    if "gpt" in name or name.startswith(("o1", "o3", "o4")) or "/o" in name:
+        # OpenAI fits images into 2048x2048, then scales the short side down to 768
+        return 2048, 768
+    if "gemini" in name:
+        return 1536, 1536
+    return 1568, 1568
+
+
+def estimate_image_tokens(width: int, height: int, model: str = None) -> int:
+    """Rough vision-token cost of an image of this size, following each provider's published rule."""
+    name = (model or "").lower()
+    if "claude" in name:
+        return math.ceil(width * height / 750)
+    if "gemini" in name:
+        if width <= 384 and height <= 384:
+            return 258
+        return 258 * math.ceil(width / 768) * math.ceil(height / 768)
+    # OpenAI high detail: 85 base + 170 per 512px tile after its own resizing
+    scale = min(1.0, 2048 / max(width, height))
+    w, h = width * scale, height * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    return 85 + 170 * math.ceil(w / 512) * math.ceil(h / 512)
+
+
+def target_size(width: int, height: int, model: str = None):
+    long_edge, short_edge = image_limits(model)
+    scale = min(1.0, long_edge / max(width, height), short_edge / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class ImageStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = 0
+        self.resized = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.ocr_pages = 0
+        self.ocr_bytes = 0
+        self.ocr_tokens = 0
+
+    def record_image(self, bytes_in, bytes_out, tokens_in, tokens_out, resized):
+        with self._lock:
+            self.images += 1
+            self.resized += int(resized)
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.tokens_in += tokens_in
+            self.tokens_out += tokens_out
+
+    def record_ocr_page(self, size, tokens):
+        with self._lock:
+            self.ocr_pages += 1
+            self.ocr_bytes += size
+            self.ocr_tokens += tokens
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "chat_images": self.images,
+                "chat_images_resized": self.resized,
+                "chat_bytes_in": self.bytes_in,
+                "chat_bytes_out": self.bytes_out,
+                "chat_bytes_saved": self.bytes_in - self.bytes_out,
+                "chat_tokens_saved": self.tokens_in - self.tokens_out,
+                "ocr_pages": self.ocr_pages,
+                "ocr_bytes": self.ocr_bytes,
+                "ocr_tokens": self.ocr_tokens,
+            }
+
+
+image_stats = ImageStats()
+
+
+def decode_data_url(data_url: str):
+    """Splits a base64 data URL into (bytes, mime type)."""
+    header, _, payload = data_url.partition(",")
+    mime = header[5:].split(";")[0]
+    try:
+        return base64.b64decode(payload, validate=True), mime or "image/png"
+    except ValueError as e:
+        raise InvalidImage(f"Image data URL is not valid base64: {e}")
+
+
+def to_data_url(data: bytes, mime: str) -> str:
+    return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+def prepare_image(data: bytes, mime: str = None, model: str = None):
+    """Downscales and recompresses an image for the given model. Returns (bytes, mime)."""
+    if len(data) > IMAGE_MAX_BYTES:
+        raise ImageTooLarge(f"Image is {len(data) // 1024} KB; the limit is {IMAGE_MAX_BYTES // 1024} KB.")
+    if Image is None:
+        return data, mime or "image/png"
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        width, height = img.size
+        new_size = target_size(width, height, model)
+        resized = new_size != (width, height)
+        # JPEG can decode straight at a reduced scale, which is far cheaper than a full decode + resize
+        img.draft("RGB", new_size)
+        img = ImageOps.exif_transpose(img)
+        final_size = target_size(*img.size, model)
+        if img.size != final_size:
+            img = img.resize(final_size, Image.LANCZOS)
+
+        out = io.BytesIO()
+        if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+            img.save(out, format="PNG", optimize=True)
+            out_mime = "image/png"
+        else:
+            img.convert("RGB").save(out, format="JPEG", quality=IMAGE_QUALITY, optimize=True)
+            out_mime = "image/jpeg"
+        result = out.getvalue()
+    except Exception as e:
+        print(f"DEBUG: Image preparation failed, sending original: {e}")
+        return data, mime or "image/png"
+
+    if not resized and len(result) > len(data) * 0.75:
+        # Already small enough; recompressing would only lose quality for little gain
+        result, out_mime = data, mime or out_mime
+    image_stats.record_image(
+        len(data), len(result),
+        estimate_image_tokens(width, height, model), estimate_image_tokens(*new_size, model),
+        resized
+    )
+    print(f"DEBUG: Prepared image {width}x{height} -> {new_size[0]}x{new_size[1]}, {len(data) // 1024} KB -> {len(result) // 1024} KB")
+    return result, out_mime
+
+
+def prepare_data_url(data_url: str, model: str = None) -> str:
+    """prepare_image for images that arrive as data URLs in JSON requests.
+
+    Anything else (an http(s) image URL, a non-base64 data URL) is passed to the provider unchanged.
+    """
+    header = data_url.partition(",")[0]
+    if not header.startswith("data:") or not header.endswith(";base64"):
+        return data_url
+    data, mime = decode_data_url(data_url)
+    return to_data_url(*prepare_image(data, mime, model))
+
+
+def ocr_dpi(page, model: str = None) -> int:
+    """DPI at which the page fills the model's resolution budget, clamped to a readable range."""
+    long_edge, short_edge = image_limits(model)
+    width_in, height_in = page.rect.width / 72, page.rect.height / 72
+    dpi = min(long_edge / max(width_in, height_in), short_edge / min(width_in, height_in))
+    return int(max(OCR_MIN_DPI, min(OCR_MAX_DPI, dpi)))
+
+
+def render_page_for_ocr(page, model: str = None):
+    """Renders a PyMuPDF page as a grayscale JPEG for OCR. Returns (bytes, mime)."""
+    pix = page.get_pixmap(dpi=ocr_dpi(page, model), colorspace=fitz.csGRAY)
+    data = pix.tobytes("jpeg", jpg_quality=OCR_QUALITY)
+    image_stats.record_ocr_page(len(data), estimate_image_tokens(pix.width, pix.height, model))
+    return data, "image/jpeg"
@@ -4,12 +4,33 @@ from pathlib import Path
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Depends, Request, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from rag_engine import RAGEngine
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from pydantic import BaseModel, ValidationError
+from rag_engine import RAGEngine, PERSIST_DIRECTORY
+from http_pool import pool_stats, close_pools
+from admission import AdmissionRejected, scheduler_stats
+from failover import health_stats
+from singleflight import chat_flights
+from static_files import ApiGZipMiddleware, PrecompressedStaticFiles, precompress_directory
+from maintenance import GCAlreadyRunning, gc_stats, run_gc, start_scheduler
+from pdf_profiler import strategy_stats
+from prompts import prompt_cache_stats
+from workers import WORKERS, CHROMA_URL, is_primary_worker, start_chroma_server, worker_stats
+from vector_stores import BACKEND
+from partitions import PARTITION_MODE
+from images import ImageTooLarge, InvalidImage, image_stats, prepare_image, prepare_data_url, to_data_url
 from typing import List, Optional, Any
+import json
+import time
+import secrets
+import threading
 import uvicorn
+from urllib.parse import quote
 from sqlalchemy.orm import Session
-from database import ChatSessionDB, get_db, init_db
+from database import ChatSessionDB, DeletedSessionDB, get_db, init_db
 
 # Load environment variables from root directory
 backend_dir = Path(__file__).parent
@@ -31,9 +52,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress large JSON API responses (history, document lists, stats)
+app.add_middleware(ApiGZipMiddleware)
+
 # Global RAG Engine instance (lazy initialization)
 rag_engine: Optional[RAGEngine] = None
 
+# Warm start: build and prime the engine in the background at boot instead of on the first request
+WARM_START = os.getenv("FREEGPT_WARM_START", "").lower() in ("1", "true", "yes")
+engine_ready = threading.Event()
+# Guards replacing rag_engine (request-time re-initialisation and the warm start)
+engine_lock = threading.Lock()
+warm_start_error: Optional[str] = None
+
 # --- Pydantic Models ---
 class ChatRequest(BaseModel):
     message: str
@@ -48,6 +79,16 @@ class ChatRequest(BaseModel):
     systemInstruction: Optional[str] = None
     sessionId: Optional[str] = None
 
+class ChatBatchRequest(BaseModel):
+    queries: List[str]
+    apiKey: Optional[str] = None
+    model: Optional[str] = "gemini-1.5-pro"
+    providerUrl: Optional[str] = None
+    deepThink: Optional[bool] = False
+    systemInstruction: Optional[str] = None
+    sessionId: Optional[str] = None
+    maxConcurrency: Optional[int] = None
+
 class IngestRequest(BaseModel):
     text: str
     source: Optional[str] = "user_upload"
@@ -61,11 +102,14 @@ class ChatSessionModel(BaseModel):
     messages: List[Any] # Message objects
 
 # --- RAG Engine Helper ---
+def get_default_api_key() -> Optional[str]:
+    return os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
+
 def get_rag_engine(request: Request, apiKey: Optional[str] = None):
-    global rag_engine
+    global rag_engine, warm_start_error
     
     # Try to get API key from request header, body (if passed), or env
-    key = apiKey or request.headers.get("x-api-key") or os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
+    key = apiKey or request.headers.get("x-api-key") or get_default_api_key()
     
     if not key:
         print("DEBUG: API Key missing in get_rag_engine")
@@ -73,33 +117,108 @@ def get_rag_engine(request: Request, apiKey: Optional[str] = None):
     
     print(f"DEBUG: get_rag_engine called. Key provided: {key[:5]}...")
     
-    # If engine exists but key changed, or not exists, initialize
-    if rag_engine:
-        print(f"DEBUG: Global rag_engine exists. Current key in engine: {rag_engine.api_key[:5]}...")
-        if rag_engine.api_key != key:
-             print(f"DEBUG: Re-initializing RAGEngine with new key (old: {rag_engine.api_key[:5]}..., new: {key[:5]}...)")
-             try:
-                rag_engine = RAGEngine(api_key=key)
-             except Exception as e:
-                print(f"Error re-initializing RAGEngine: {e}")
-                pass
+    # Check and swap under the lock the warm start assigns under too
+    with engine_lock:
+        # If engine exists but key changed, or not exists, initialize
+        if rag_engine:
+            print(f"DEBUG: Global rag_engine exists. Current key in engine: {rag_engine.api_key[:5]}...")
+            if rag_engine.api_key != key:
+                 print(f"DEBUG: Re-initializing RAGEngine with new key (old: {rag_engine.api_key[:5]}..., new: {key[:5]}...)")
+                 try:
+                    rag_engine = RAGEngine(api_key=key)
+                 except Exception as e:
+                    print(f"Error re-initializing RAGEngine: {e}")
+                    pass
+            else:
+                 print("DEBUG: Keys match. Reusing existing RAGEngine.")
         else:
-             print("DEBUG: Keys match. Reusing existing RAGEngine.")
-    else:
-        print(f"DEBUG: Global rag_engine is None. Initializing RAGEngine with key: {key[:5]}...")
-        try:
-            rag_engine = RAGEngine(api_key=key)
-        except Exception as e:
-            error_msg = str(e).lower()
-            if "api key" in error_msg or "401" in error_msg or "unauthorized" in error_msg:
-                raise HTTPException(status_code=401, detail=f"Authentication Error: {str(e)}")
-            raise HTTPException(status_code=500, detail=str(e))
-            
-    if rag_engine:
-        status = "Initialized" if rag_engine.vector_store is not None else "None"
+            print(f"DEBUG: Global rag_engine is None. Initializing RAGEngine with key: {key[:5]}...")
+            try:
+                rag_engine = RAGEngine(api_key=key)
+            except Exception as e:
+                error_msg = str(e).lower()
+                if "api key" in error_msg or "401" in error_msg or "unauthorized" in error_msg:
+                    raise HTTPException(status_code=401, detail=f"Authentication Error: {str(e)}")
+                raise HTTPException(status_code=500, detail=str(e))
+        if rag_engine is not None and rag_engine.api_key == key:
+            # A working engine exists now, whatever an earlier warm start ran into
+            warm_start_error = None
+        engine = rag_engine
+
+    if engine:
+        status = "Initialized" if engine.vector_store is not None else "None"
         print(f"DEBUG: Returning RAGEngine. VectorStore status: {status}")
     
-    return rag_engine
+    return engine
+
+# --- Warm Start ---
+def warm_start():
+    global rag_engine, warm_start_error
+
+    key = get_default_api_key()
+    try:
+        if not key:
+            print("DEBUG: Warm start - no API key configured, engine will be built on first request.")
+            return
+
+        print(f"DEBUG: Warm start - building RAGEngine with key: {key[:5]}...")
+        engine = RAGEngine(api_key=key)
+        engine.warm_up()
+
+        # Don't clobber an engine a request already built for a different key meanwhile
+        with engine_lock:
+            if rag_engine is None or rag_engine.api_key == key:
+                rag_engine = engine
+        print("DEBUG: Warm start complete.")
+    except Exception as e:
+        print(f"Error during warm start: {e}")
+        warm_start_error = str(e)
+    finally:
+        engine_ready.set()
+
+@app.on_event("startup")
+def start_warm_start():
+    if WARM_START:
+        threading.Thread(target=warm_start, name="warm-start", daemon=True).start()
+    else:
+        engine_ready.set()
+
+@app.on_event("startup")
+def start_storage_gc():
+    # One scheduled collection for the whole server, not one per worker
+    if is_primary_worker():
+        start_scheduler(lambda: rag_engine, UPLOADS_DIR)
+
+@app.on_event("shutdown")
+async def shutdown_http_pools():
+    await close_pools()
+
+@app.get("/api/health")
+def health():
+    return {"status": "ok"}
+
+@app.get("/api/ready")
+def readiness():
+    if not engine_ready.is_set():
+        return JSONResponse(status_code=503, content={"status": "warming"})
+    # A failed warm start only matters until some request has built a working engine
+    if warm_start_error and rag_engine is None:
+        return JSONResponse(status_code=503, content={"status": "error", "detail": warm_start_error})
+    return {"status": "ready", "engine": rag_engine is not None}
+
+@app.get("/api/stats")
+def get_stats():
+    return {
+        "http_pool": pool_stats(),
+        "providers": scheduler_stats(),
+        "provider_health": health_stats(),
+        "single_flight": chat_flights.stats(),
+        "images": image_stats.snapshot(),
+        "storage_gc": gc_stats(),
+        "pdf_strategies": strategy_stats(),
+        "prompt_cache": prompt_cache_stats.snapshot(),
+        "worker": worker_stats()
+    }
 
 # (Root endpoint removed to allow SPA serving)
 
@@ -147,30 +266,72 @@ def delete_history(session_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Session not found")
     
     db.delete(db_session)
+    if PARTITION_MODE == "session":
+        # Tombstone for storage GC, in case the knowledge below can't be dropped right now
+        db.merge(DeletedSessionDB(id=session_id, deleted_at=time.time()))
     db.commit()
+
+    # With session partitions the session's uploaded knowledge goes with it, if an engine is already running
+    if PARTITION_MODE == "session" and rag_engine is not None:
+        rag_engine.delete_session_knowledge(session_id)
     return {"status": "deleted"}
 
 # --- RAG Endpoints ---
 
 import traceback
 
+def too_many_requests(e: AdmissionRejected):
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+async def read_chat_request(request: Request):
+    """Parses a chat request: JSON (image as a data URL) or multipart with the request JSON in a
+    'payload' field and the image as a binary 'image' part. Returns (body, image_bytes, image_type)."""
+    try:
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            form = await request.form()
+            body = ChatRequest.model_validate_json(form.get("payload") or "{}")
+            upload = form.get("image")
+            if upload is not None and hasattr(upload, "read"):
+                return body, await upload.read(), upload.content_type
+            return body, None, None
+        return ChatRequest.model_validate_json(await request.body()), None, None
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+def filter_provider_url(provider_url: Optional[str]) -> Optional[str]:
+    # Logic to prevent self-referencing base_url
+    if provider_url:
+        normalized = provider_url.lower().replace("http://", "").replace("https://", "").replace("/", "")
+        if "localhost" in normalized or "127.0.0.1" in normalized or "0.0.0.0" in normalized:
+            return None
+    return provider_url
+
 @app.post("/api/chat")
-async def chat_endpoint(request: Request, body: ChatRequest):
+async def chat_endpoint(request: Request):
+    body, image_bytes, image_type = await read_chat_request(request)
+    # Downscale to what the model can use before anything else sees the image (single-flight keys included)
+    image = body.image
+    try:
+        if image_bytes:
+            image = to_data_url(*await run_in_threadpool(prepare_image, image_bytes, image_type, body.model))
+        elif image:
+            image = await run_in_threadpool(prepare_data_url, image, body.model)
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except InvalidImage as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     try:
         print(f"Received chat request for model: {body.model}")
         
-        # Logic to prevent self-referencing base_url
-        provider_url = body.providerUrl
-        if provider_url:
-            normalized = provider_url.lower().replace("http://", "").replace("https://", "").replace("/", "")
-            if "localhost" in normalized or "127.0.0.1" in normalized or "0.0.0.0" in normalized:
-                 provider_url = None
-                 
+        provider_url = filter_provider_url(body.providerUrl)
         engine = get_rag_engine(request, apiKey=body.apiKey)
         
-        response = engine.get_response(
+        # Provider calls block while waiting for an admission slot, so keep them off the event loop
+        response = await run_in_threadpool(
+            engine.get_response,
             body.message, 
-            image=body.image,
+            image=image,
             model_name=body.model,
             base_url=provider_url, # Use filtered URL
             api_key=body.apiKey, # Pass key dynamically
@@ -183,10 +344,13 @@ async def chat_endpoint(request: Request, body: ChatRequest):
         )
         
         if isinstance(response, dict):
-            return {"response": response["answer"], "sources": response.get("sources", [])}
+            return {"response": response["answer"], "sources": response.get("sources", []), "usage": response.get("usage")}
         else:
             return {"response": response, "sources": []}
             
+    except AdmissionRejected as e:
+        print(f"Chat request rejected: {e}")
+        raise too_many_requests(e)
     except Exception as e:
         print("Error in chat_endpoint:")
         traceback.print_exc() # Print full stack trace
@@ -195,20 +359,55 @@ async def chat_endpoint(request: Request, body: ChatRequest):
             raise HTTPException(status_code=401, detail=f"Authentication Error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+BATCH_MAX_QUERIES = int(os.getenv("FREEGPT_BATCH_MAX_QUERIES", "1000"))
+
+@app.post("/api/chat/batch")
+async def chat_batch_endpoint(request: Request, body: ChatBatchRequest):
+    """Answers many independent questions; streams one JSON object per line as each one finishes."""
+    if not body.queries:
+        raise HTTPException(status_code=400, detail="No queries given")
+    if len(body.queries) > BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_QUERIES} queries per batch")
+
+    engine = get_rag_engine(request, apiKey=body.apiKey)
+    try:
+        # Embedding and retrieval for the whole batch happen here, so their errors still get a status code
+        results = await run_in_threadpool(
+            engine.answer_batch,
+            body.queries,
+            model_name=body.model,
+            base_url=filter_provider_url(body.providerUrl),
+            api_key=body.apiKey,
+            system_instruction=body.systemInstruction,
+            session_id=body.sessionId,
+            deep_think=body.deepThink,
+            max_concurrency=body.maxConcurrency
+        )
+    except AdmissionRejected as e:
+        raise too_many_requests(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    def ndjson():
+        for item in results:
+            yield json.dumps(item) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
 @app.post("/api/ingest")
 async def ingest_endpoint(request: Request, body: IngestRequest):
     engine = get_rag_engine(request, apiKey=body.apiKey)
     try:
-        count = engine.ingest_text(body.text, body.source)
+        count = await run_in_threadpool(engine.ingest_text, body.text, body.source)
         return {"status": "success", "chunks_added": count}
+    except AdmissionRejected as e:
+        raise too_many_requests(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
 import sys
 import webbrowser
-import threading
 
 # Ensure uploads directory exists relative to CWD
 BASE_DIR = Path(os.getcwd())
@@ -237,7 +436,7 @@ async def upload_file(
             shutil.copyfileobj(file.file, buffer)
             
         # Process the file
-        count = engine.ingest_file(str(file_path), file.filename, session_id=sessionId)
+        count = await run_in_threadpool(engine.ingest_file, str(file_path), file.filename, session_id=sessionId)
         
         # Note: File is kept for future downloads
         
@@ -248,14 +447,28 @@ async def upload_file(
         # Clean up if ingestion failed
         if os.path.exists(UPLOADS_DIR / file.filename):
              os.remove(UPLOADS_DIR / file.filename)
+        if isinstance(e, AdmissionRejected):
+            raise too_many_requests(e)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.delete("/api/sessions/{session_id}/documents")
+def delete_session_documents(session_id: str, request: Request, apiKey: Optional[str] = None):
+    engine = get_rag_engine(request, apiKey=apiKey)
+    if engine.delete_session_knowledge(session_id):
+        return {"status": "deleted", "sessionId": session_id}
+    raise HTTPException(status_code=404, detail="No knowledge stored for this session")
+
+# StaticFiles gives downloads ETag/Last-Modified, 304 revalidation and Range requests (resumable, seekable)
+uploads_files = StaticFiles(directory=str(UPLOADS_DIR))
+
 @app.get("/api/documents/{filename}/download")
-def download_document(filename: str):
-    file_path = UPLOADS_DIR / filename
-    if not file_path.exists():
+async def download_document(filename: str, request: Request):
+    try:
+        response = await uploads_files.get_response(filename, request.scope)
+    except StarletteHTTPException:
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(path=file_path, filename=filename, media_type='application/octet-stream')
+    response.headers["content-disposition"] = f"attachment; filename*=utf-8''{quote(filename)}"
+    return response
 
 @app.get("/api/documents")
 def list_documents(request: Request, apiKey: Optional[str] = None):
@@ -267,10 +480,42 @@ def delete_document(filename: str, request: Request, apiKey: Optional[str] = Non
     engine = get_rag_engine(request, apiKey=apiKey)
     success = engine.delete_document(filename)
     if success:
+        # The original file goes too, otherwise uploads/ only ever grows
+        file_path = UPLOADS_DIR / filename
+        if file_path.parent == UPLOADS_DIR and file_path.is_file():
+            os.remove(file_path)
         return {"status": "deleted", "filename": filename}
     else:
         raise HTTPException(status_code=500, detail="Failed to delete document")
 
+# --- Maintenance ---
+
+ADMIN_TOKEN = os.getenv("FREEGPT_ADMIN_TOKEN")
+
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+def check_admin(request: Request):
+    if ADMIN_TOKEN:
+        if not secrets.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+            raise HTTPException(status_code=403, detail="Admin token required")
+    elif request.client is None or request.client.host not in LOOPBACK_HOSTS:
+        # Without a token only the machine the server runs on may use the admin API
+        raise HTTPException(status_code=403, detail="Set FREEGPT_ADMIN_TOKEN to use the admin API from other hosts")
+
+@app.post("/api/admin/gc")
+async def storage_gc(request: Request, dryRun: bool = False):
+    check_admin(request)
+    try:
+        # Runs in a worker thread; chat and upload requests keep being served meanwhile
+        return await run_in_threadpool(run_gc, rag_engine, UPLOADS_DIR, dry_run=dryRun)
+    except GCAlreadyRunning as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.get("/api/admin/gc")
+def storage_gc_report(request: Request):
+    check_admin(request)
+    return {"last_run": gc_stats()}
+
 # --- Path helper for PyInstaller ---
 def get_base_path():
     if hasattr(sys, '_MEIPASS'):
@@ -285,15 +530,18 @@ print(f"DEBUG: Looking for frontend at: {frontend_dist.absolute()}")
 
 if frontend_dist.exists():
     print("DEBUG: Frontend directory FOUND.")
-    app.mount("/assets", StaticFiles(directory=str(frontend_dist / "assets")), name="assets")
+    # No-op when the build already precompressed the files
+    precompress_directory(frontend_dist)
+    spa_files = PrecompressedStaticFiles(directory=str(frontend_dist))
+    app.mount("/assets", PrecompressedStaticFiles(directory=str(frontend_dist / "assets")), name="assets")
     
     # Catch-all route for SPA - MUST BE LAST
     @app.get("/{full_path:path}")
-    async def serve_spa(full_path: str):
+    async def serve_spa(full_path: str, request: Request):
         # Allow API requests to pass through
         if full_path.startswith("api"):
             raise HTTPException(status_code=404)
-        return FileResponse(frontend_dist / "index.html")
+        return await spa_files.get_response("index.html", request.scope)
 else:
     print("WARNING: Frontend 'dist' directory not found. Run 'npm run build' to generate it.")
 
@@ -311,5 +559,18 @@ if __name__ == "__main__":
             print(f"{route.methods} {route.path}")
     print("-------------------------")
 
-    # Pass the app object directly to avoid import issues in PyInstaller
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=False)
\ No newline at end of file
+    workers = WORKERS
+    if workers > 1 and getattr(sys, "frozen", False):
+        print("WARNING: FREEGPT_WORKERS is not supported in the packaged executable; running one worker.")
+        workers = 1
+
+    if workers == 1:
+        # Pass the app object directly to avoid import issues in PyInstaller
+        uvicorn.run(app, host="0.0.0.0", port=8000, reload=False)
+    else:
+        if BACKEND != "mmap" and not CHROMA_URL:
+            # Workers must not open chroma_data in-process side by side; they share one server instead
+            os.environ["FREEGPT_CHROMA_URL"] = start_chroma_server(PERSIST_DIRECTORY)
+        print(f"DEBUG: Starting {workers} worker processes...")
+        # Workers are separate processes that import the app by name
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers, app_dir=str(backend_dir))
\ No newline at end of file
@@ -0,0 +1,213 @@
+import os
+import re
+import time
+import shutil
+import sqlite3
+import threading
+
+from database import SessionLocal, ChatSessionDB, DeletedSessionDB, engine as db_engine
+from vector_stores import ChromaBackend, directory_size
+from workers import FileLock
+
+# Storage garbage collection and compaction.
+# Removes upload files no document in the knowledge base refers to, chunks of chat sessions that
+# were deleted, and then gives the space back: VACUUM for chats.db and Chroma's SQLite file,
+# deletion of Chroma segment directories left behind by dropped collections, and compaction of
+# the mmap index. Runs on a schedule (FREEGPT_GC_INTERVAL_HOURS) and via POST /api/admin/gc.
+# Every step only takes the locks the live code paths already use, and only for short swaps.
+# With several workers only one of them runs the schedule, and a lock file keeps a manual run in
+# another worker from overlapping it.
+
+GC_INTERVAL_HOURS = float(os.getenv("FREEGPT_GC_INTERVAL_HOURS", "24"))
+# Upload files and Chroma segment directories younger than this are left alone: they may belong
+# to an upload still being ingested
+GC_GRACE_SECONDS = int(os.getenv("FREEGPT_GC_GRACE_SECONDS", "3600"))
+# Only VACUUM a SQLite file when at least this fraction of its pages is free
+VACUUM_MIN_FREE_RATIO = float(os.getenv("FREEGPT_VACUUM_MIN_FREE", "0.1"))
+
+SEGMENT_DIR = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+class GCAlreadyRunning(Exception):
+    """Raised when a collection is requested while another one is in progress."""
+
+
+_gc_lock = FileLock(os.path.join(os.getcwd(), "storage_gc.lock"))
+last_report = None
+
+
+def _file_size(path) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _sqlite_size(path) -> int:
+    return sum(_file_size(str(path) + suffix) for suffix in ("", "-wal", "-shm"))
+
+
+def vacuum_sqlite(path, dry_run: bool = False) -> dict:
+    """VACUUMs a SQLite file if enough of it is free pages. Returns what was (or would be) reclaimed."""
+    if not os.path.exists(path):
+        return {"skipped": "missing"}
+    before = _sqlite_size(path)
+    try:
+        conn = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+        try:
+            pages = conn.execute("PRAGMA page_count").fetchone()[0]
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            if not pages or free / pages < VACUUM_MIN_FREE_RATIO:
+                return {"free_bytes": free * page_size, "bytes_reclaimed": 0, "skipped": "below threshold"}
+            if dry_run:
+                return {"free_bytes": free * page_size, "bytes_reclaimed": 0}
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+    except sqlite3.OperationalError as e:
+        # Busy with a long write; the next run will try again
+        print(f"DEBUG: VACUUM of {path} skipped: {e}")
+        return {"skipped": str(e), "bytes_reclaimed": 0}
+    return {"free_bytes": free * page_size, "bytes_reclaimed": max(0, before - _sqlite_size(path))}
+
+
+def collect_uploads(uploads_dir, sources, dry_run: bool = False) -> dict:
+    """Removes files in uploads/ that no document in the knowledge base was ingested from."""
+    removed, reclaimed = [], 0
+    cutoff = time.time() - GC_GRACE_SECONDS
+    for entry in os.scandir(uploads_dir):
+        if not entry.is_file() or entry.name in sources:
+            continue
+        stat = entry.stat()
+        if stat.st_mtime > cutoff:
+            continue
+        if not dry_run:
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                print(f"DEBUG: Could not remove orphaned upload {entry.name}: {e}")
+                continue
+        removed.append(entry.name)
+        reclaimed += stat.st_size
+    return {"removed": removed, "bytes_reclaimed": reclaimed}
+
+
+def collect_session_chunks(vector_store, dry_run: bool = False) -> dict:
+    """Drops the knowledge of chat sessions that were deleted from the history.
+
+    Only sessions with a tombstone (written when a chat is deleted) are collected: knowledge
+    tagged with an id that never was a chat, e.g. from bulk_ingest --session-id, is kept.
+    """
+    db = SessionLocal()
+    try:
+        tombstones = {row.id for row in db.query(DeletedSessionDB.id).all()}
+        if not tombstones:
+            return {"sessions": []}
+        # A chat saved again under a deleted id is live again
+        live = {row.id for row in db.query(ChatSessionDB.id).filter(ChatSessionDB.id.in_(tombstones))}
+        orphaned = [session_id for session_id in vector_store.session_activity() if session_id in tombstones - live]
+        if not dry_run:
+            for session_id in orphaned:
+                vector_store.drop_session(session_id)
+            db.query(DeletedSessionDB).filter(DeletedSessionDB.id.in_(tombstones)).delete(synchronize_session=False)
+            db.commit()
+    finally:
+        db.close()
+    return {"sessions": orphaned}
+
+
+def collect_chroma_segments(store: ChromaBackend, dry_run: bool = False) -> dict:
+    """Deletes segment directories that no collection in chroma.sqlite3 refers to any more."""
+    directory = store.persist_directory
+    # List the directories before reading the segments table: Chroma adds the segment row when a
+    # collection is created and its directory only on first write, so a directory listed first is
+    # always covered by the rows read afterwards. New directories are left alone regardless.
+    cutoff = time.time() - GC_GRACE_SECONDS
+    candidates = []
+    for entry in os.scandir(directory):
+        if entry.is_dir() and SEGMENT_DIR.match(entry.name):
+            try:
+                if entry.stat().st_mtime <= cutoff:
+                    candidates.append(entry)
+            except OSError:
+                continue
+    try:
+        conn = sqlite3.connect(f"file:{os.path.join(directory, 'chroma.sqlite3')}?mode=ro", uri=True, timeout=30)
+        try:
+            referenced = {row[0] for row in conn.execute("SELECT id FROM segments")}
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        return {"skipped": str(e), "bytes_reclaimed": 0}
+
+    removed, reclaimed = [], 0
+    for entry in candidates:
+        if entry.name not in referenced:
+            reclaimed += directory_size(entry.path)
+            if not dry_run:
+                shutil.rmtree(entry.path, ignore_errors=True)
+            removed.append(entry.name)
+    return {"removed": removed, "bytes_reclaimed": reclaimed}
+
+
+def run_gc(rag_engine, uploads_dir, dry_run: bool = False) -> dict:
+    """Runs one collection and returns a report of what was removed and the space reclaimed."""
+    global last_report
+    if not _gc_lock.acquire(blocking=False):
+        raise GCAlreadyRunning("A storage collection is already running.")
+    try:
+        start = time.monotonic()
+        print(f"DEBUG: Storage GC started{' (dry run)' if dry_run else ''}...")
+        report = {"dry_run": dry_run}
+        vector_store = rag_engine.vector_store if rag_engine is not None else None
+
+        if vector_store is not None:
+            # Chunks first, so uploads of sessions dropped here are seen as orphaned below
+            report["session_chunks"] = collect_session_chunks(vector_store, dry_run)
+            report["uploads"] = collect_uploads(uploads_dir, set(vector_store.list_sources()), dry_run)
+            if isinstance(vector_store.global_store, ChromaBackend):
+                report["chroma_segments"] = collect_chroma_segments(vector_store.global_store, dry_run)
+                report["chroma_sqlite"] = vacuum_sqlite(os.path.join(vector_store.persist_directory, "chroma.sqlite3"), dry_run)
+            else:
+                report["vector_index"] = {"bytes_reclaimed": 0 if dry_run else vector_store.compact()}
+        else:
+            # Without the knowledge base there is no way to tell which uploads are orphaned
+            report["uploads"] = {"skipped": "engine not initialized"}
+
+        report["chats_db"] = vacuum_sqlite(db_engine.url.database, dry_run)
+        report["bytes_reclaimed"] = sum(
+            part.get("bytes_reclaimed", 0) for part in report.values() if isinstance(part, dict)
+        )
+        report["duration_s"] = round(time.monotonic() - start, 2)
+        report["finished_at"] = int(time.time())
+        print(f"DEBUG: Storage GC finished in {report['duration_s']}s, {report['bytes_reclaimed']} bytes reclaimed.")
+        last_report = report
+        return report
+    finally:
+        _gc_lock.release()
+
+
+def gc_stats():
+    return last_report
+
+
+def start_scheduler(get_engine, uploads_dir):
+    """Runs run_gc every FREEGPT_GC_INTERVAL_HOURS in a daemon thread (0 disables it)."""
+    if GC_INTERVAL_HOURS <= 0:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(GC_INTERVAL_HOURS * 3600)
+            try:
+                run_gc(get_engine(), uploads_dir)
+            except GCAlreadyRunning:
+                pass
+            except Exception as e:
+                print(f"Storage GC failed: {e}")
+
+    thread = threading.Thread(target=loop, name="storage-gc", daemon=True)
+    thread.start()
+    return thread
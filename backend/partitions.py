@@ -0,0 +1,248 @@
+import os
+import hashlib
+import threading
+
+from vector_stores import BACKEND, create_vector_store, list_partitions
+from workers import WORKERS
+from embeddings import EmbeddingModelMismatch
+
+# Routing layer between RAGEngine and the vector store.
+# With FREEGPT_PARTITIONING=session every chat session's documents live in their own partition
+# (a Chroma collection or an index directory), so a session query only searches that partition
+# (plus the shared global one if FREEGPT_SEARCH_GLOBAL is on) and dropping a session's knowledge
+# removes the partition instead of filtering across everything.
+# With the default 'none' everything stays in the single global collection, filtered by session_id.
+# With several worker processes a partition may be created or dropped by another worker, so the
+# set of partitions is re-read from the store instead of trusted from memory.
+
+PARTITION_MODE = os.getenv("FREEGPT_PARTITIONING", "none").lower()
+SEARCH_GLOBAL = os.getenv("FREEGPT_SEARCH_GLOBAL", "").lower() in ("1", "true", "yes")
+
+
+def partition_for(session_id: str) -> str:
+    """Stable partition name for a session (safe as a collection or directory name)."""
+    return hashlib.sha1(session_id.encode("utf-8")).hexdigest()[:24]
+
+
+class PartitionRouter:
+    def __init__(self, embeddings, persist_directory: str, backend: str = BACKEND, mode: str = PARTITION_MODE, embedding_model: str = None):
+        self.embeddings = embeddings
+        self.embedding_model = embedding_model
+        self.persist_directory = persist_directory
+        self.backend = backend
+        self.partitioned = mode == "session"
+        self._lock = threading.Lock()
+
+        self.global_store = self._open()
+        self.name = self.global_store.name
+        self._partitions = {}
+        if self.partitioned:
+            self._known = set(list_partitions(self.global_store))
+            print(f"DEBUG: Session partitioning enabled ({len(self._known)} partitions on disk).")
+        else:
+            self._known = set()
+
+    def _open(self, partition: str = None):
+        store = create_vector_store(self.embeddings, self.persist_directory, self.backend, partition=partition)
+        self._check_embedding_model(store, partition)
+        return store
+
+    def _check_embedding_model(self, store, partition: str = None):
+        """Refuses stores built with another embedding model; their vectors are not comparable."""
+        recorded = store.get_embedding_model()
+        label = f"partition {partition}" if partition else "global store"
+        if self.embedding_model is None:
+            # Maintenance tools run without embeddings; new partitions inherit the global model
+            if recorded is None and partition and self.global_store.get_embedding_model():
+                store.set_embedding_model(self.global_store.get_embedding_model())
+            return
+        if recorded is None:
+            if store.count():
+                print(f"Warning: {label} predates embedding model tracking; assuming it was built with {self.embedding_model}.")
+            store.set_embedding_model(self.embedding_model)
+        elif recorded != self.embedding_model:
+            raise EmbeddingModelMismatch(
+                f"The {label} was built with embeddings from '{recorded}' but '{self.embedding_model}' is configured. "
+                "Set FREEGPT_EMBEDDING_PROVIDER to match, or re-ingest the documents."
+            )
+
+    def _partition(self, session_id: str, create: bool = False):
+        """Returns the store for a session, creating it lazily on first write."""
+        name = partition_for(session_id)
+        if WORKERS > 1 and not create and name not in self._known:
+            self._sync_known()
+        with self._lock:
+            store = self._partitions.get(name)
+            if store is None and (create or name in self._known):
+                store = self._open(name)
+                self._partitions[name] = store
+                self._known.add(name)
+            return store
+
+    def _sync_known(self):
+        """Re-reads which partitions exist, forgetting those another worker dropped."""
+        names = set(list_partitions(self.global_store))
+        with self._lock:
+            self._known = names
+            for name in [name for name in self._partitions if name not in names]:
+                del self._partitions[name]
+
+    def _all_stores(self):
+        if WORKERS > 1 and self.partitioned:
+            self._sync_known()
+        with self._lock:
+            names = set(self._known)
+        stores = [self.global_store]
+        for name in names:
+            with self._lock:
+                store = self._partitions.get(name)
+                if store is None:
+                    store = self._open(name)
+                    self._partitions[name] = store
+            stores.append(store)
+        return stores
+
+    # --- Writes ---
+
+    def add_documents(self, documents, session_id: str = None) -> int:
+        if self.partitioned and session_id:
+            return self._partition(session_id, create=True).add_documents(documents)
+        return self.global_store.add_documents(documents)
+
+    def add_embedded(self, ids, embeddings, texts, metadatas, session_id: str = None) -> int:
+        if self.partitioned and session_id:
+            return self._partition(session_id, create=True).add_embedded(ids, embeddings, texts, metadatas)
+        return self.global_store.add_embedded(ids, embeddings, texts, metadatas)
+
+    def delete(self, where: dict = None, ids=None) -> int:
+        return sum(store.delete(where, ids=ids) for store in self._all_stores())
+
+    def drop_session(self, session_id: str) -> bool:
+        """Removes everything ingested for a session; False if there was nothing."""
+        if not self.partitioned:
+            return self.global_store.delete({"session_id": session_id}) > 0
+        name = partition_for(session_id)
+        store = self._partition(session_id)
+        if store is None:
+            return False
+        store.drop()
+        with self._lock:
+            self._partitions.pop(name, None)
+            self._known.discard(name)
+        print(f"DEBUG: Dropped knowledge partition for session {session_id}.")
+        return True
+
+    # --- Reads ---
+
+    def similarity_search(self, query: str, k: int = 5, session_id: str = None):
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k=k, session_id=session_id)
+
+    def similarity_search_by_vector(self, embedding, k: int = 5, session_id: str = None):
+        if not session_id:
+            return self.global_store.similarity_search_by_vector(embedding, k=k)
+        if not self.partitioned:
+            return self.global_store.similarity_search_by_vector(embedding, k=k, filter={"session_id": session_id})
+
+        stores = []
+        partition = self._partition(session_id)
+        if partition is not None:
+            stores.append(partition)
+        if SEARCH_GLOBAL:
+            stores.append(self.global_store)
+        if len(stores) == 1:
+            return stores[0].similarity_search_by_vector(embedding, k=k)
+
+        hits = []
+        for store in stores:
+            if store.count():
+                hits.extend(store.similarity_search_with_score_by_vector(embedding, k=k))
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+        return [doc for doc, _ in hits[:k]]
+
+    def similarity_search_by_vectors(self, embeddings, k: int = 5, session_id: str = None):
+        """One list of documents per query embedding; every store is searched once for the whole batch."""
+        embeddings = list(embeddings)
+        filter = None
+        if not session_id:
+            stores = [self.global_store]
+        elif not self.partitioned:
+            stores = [self.global_store]
+            filter = {"session_id": session_id}
+        else:
+            stores = [store for store in (self._partition(session_id), self.global_store if SEARCH_GLOBAL else None) if store is not None]
+        if len(stores) == 1:
+            return [[doc for doc, _ in hits] for hits in stores[0].similarity_search_with_score_by_vectors(embeddings, k=k, filter=filter)]
+
+        merged = [[] for _ in embeddings]
+        for store in stores:
+            if store.count():
+                for hits, store_hits in zip(merged, store.similarity_search_with_score_by_vectors(embeddings, k=k)):
+                    hits.extend(store_hits)
+        return [[doc for doc, _ in sorted(hits, key=lambda hit: hit[1], reverse=True)[:k]] for hits in merged]
+
+    def list_sources(self):
+        sources = set()
+        for store in self._all_stores():
+            sources.update(store.list_sources())
+        return list(sources)
+
+    def count(self) -> int:
+        return sum(store.count() for store in self._all_stores())
+
+    def content_hashes(self):
+        """Content hashes of every ingested file, across all partitions."""
+        hashes = set()
+        for store in self._all_stores():
+            for metadata in store.get_all(include_documents=False)["metadatas"]:
+                if metadata and metadata.get("content_hash"):
+                    hashes.add(metadata["content_hash"])
+        return hashes
+
+    def session_activity(self):
+        """Newest ingestion time per session id across all stores (0 for chunks without one)."""
+        sessions = {}
+        for store in self._all_stores():
+            for metadata in store.get_all(include_documents=False)["metadatas"]:
+                session_id = (metadata or {}).get("session_id")
+                if session_id:
+                    sessions[session_id] = max(sessions.get(session_id, 0), metadata.get("ingested_at", 0))
+        return sessions
+
+    def compact(self) -> int:
+        """Compacts every store that supports it; returns the bytes reclaimed."""
+        return sum(store.compact() for store in self._all_stores() if hasattr(store, "compact"))
+
+    def partitions(self):
+        with self._lock:
+            return sorted(self._known)
+
+    # --- Migration ---
+
+    def migrate(self, batch_size: int = 1000) -> dict:
+        """Moves session-tagged rows out of the global collection into their session partitions."""
+        if not self.partitioned:
+            raise ValueError("Set FREEGPT_PARTITIONING=session before migrating.")
+
+        data = self.global_store.get_all(include_embeddings=True)
+        by_session = {}
+        for i, metadata in enumerate(data["metadatas"]):
+            session_id = (metadata or {}).get("session_id")
+            if session_id:
+                by_session.setdefault(session_id, []).append(i)
+
+        moved = 0
+        for session_id, rows in by_session.items():
+            partition = self._partition(session_id, create=True)
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                partition.add_embedded(
+                    [data["ids"][i] for i in batch],
+                    [data["embeddings"][i] for i in batch],
+                    [data["documents"][i] for i in batch],
+                    [data["metadatas"][i] for i in batch]
+                )
+            # Only remove from the global store once the partition holds the copy
+            self.global_store.delete({"session_id": session_id})
+            moved += len(rows)
+            print(f"DEBUG: Migrated {len(rows)} chunks for session {session_id}.")
+        return {"sessions": len(by_session), "chunks": moved}
@@ -0,0 +1,257 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import Counter
+
+import fitz # pymupdf
+
+from extraction import PDF_EXTRACTORS
+
+# PDF extraction profiler and per-family strategy selection.
+# Every extractor is timed page by page on a sample of the document and its output scored
+# (empty pages, garbled characters, amount of text). The fastest extractor whose output is about
+# as good as the best one is recommended, or "ocr" when no extractor finds a text layer.
+# Recommendations are cached by the PDF's producer/creator fingerprint, so the next document
+# from the same tool goes straight to the right extractor.
+#   python pdf_profiler.py file.pdf|directory [...] [--pages N] [--save]
+
+# learn: profile the first PDF of an unknown family during ingestion; cached: only use saved
+# choices (from --save); off: always the fixed pypdf -> PyMuPDF -> pdfplumber order
+STRATEGY_MODE = os.getenv("FREEGPT_PDF_STRATEGY", "learn").lower()
+STRATEGY_CACHE_PATH = os.getenv("FREEGPT_PDF_STRATEGY_CACHE", os.path.join(os.getcwd(), "pdf_strategies.json"))
+PROFILE_PAGES = int(os.getenv("FREEGPT_PDF_PROFILE_PAGES", "5"))
+
+# An extractor is adequate if it is this close to the best one on each measure
+EMPTY_TOLERANCE = 0.05
+GARBLED_TOLERANCE = 0.01
+MIN_TEXT_SHARE = 0.8
+
+CID_GLYPH = re.compile(r"\(cid:\d+\)")
+VERSION = re.compile(r"\d+(\.\d+)*")
+
+
+def garbled_chars(text: str) -> int:
+    """Characters that are almost certainly extraction damage: unmapped glyphs, replacement and control characters."""
+    bad = sum(len(match) for match in CID_GLYPH.findall(text))
+    for ch in text:
+        if ch == "\ufffd" or "\ue000" <= ch <= "\uf8ff" or (ch < " " and ch not in "\n\r\t\f"):
+            bad += 1
+    return bad
+
+
+def pdf_fingerprint(file_path: str):
+    """Producer/creator family of a PDF with version numbers removed, or None if it has no metadata."""
+    try:
+        doc = fitz.open(file_path)
+        try:
+            metadata = doc.metadata or {}
+        finally:
+            doc.close()
+    except Exception:
+        return None
+    parts = [VERSION.sub("#", (metadata.get(key) or "").strip().lower()) for key in ("producer", "creator")]
+    if not any(parts):
+        return None
+    return "|".join(parts)
+
+
+def profile_extractor(extract, file_path: str, max_pages: int = None) -> dict:
+    result = {"pages": 0, "empty_pages": 0, "chars": 0, "garbled": 0, "seconds": 0.0, "page_ms": []}
+    pages = extract(file_path)
+    try:
+        while max_pages is None or result["pages"] < max_pages:
+            start = time.perf_counter()
+            try:
+                _, text = next(pages)
+            except StopIteration:
+                break
+            elapsed = time.perf_counter() - start
+            text = text or ""
+            result["pages"] += 1
+            result["seconds"] += elapsed
+            result["page_ms"].append(round(elapsed * 1000, 2))
+            if not text.strip():
+                result["empty_pages"] += 1
+            result["chars"] += len(text)
+            result["garbled"] += garbled_chars(text)
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        pages.close()
+    result["garbled_ratio"] = result["garbled"] / result["chars"] if result["chars"] else 0.0
+    result["ms_per_page"] = result["seconds"] * 1000 / result["pages"] if result["pages"] else None
+    return result
+
+
+def recommend(results: dict):
+    """Fastest extractor whose output is about as good as the best, 'ocr' for scans, None if all failed."""
+    usable = {name: r for name, r in results.items() if not r.get("error") and r["pages"]}
+    if not usable:
+        return None
+    if all(r["empty_pages"] == r["pages"] for r in usable.values()):
+        return "ocr"
+
+    best_empty = min(r["empty_pages"] / r["pages"] for r in usable.values())
+    best_garbled = min(r["garbled_ratio"] for r in usable.values())
+    most_chars = max(r["chars"] for r in usable.values())
+    adequate = [
+        name for name, r in usable.items()
+        if r["empty_pages"] / r["pages"] <= best_empty + EMPTY_TOLERANCE
+        and r["garbled_ratio"] <= best_garbled + GARBLED_TOLERANCE
+        and r["chars"] >= most_chars * MIN_TEXT_SHARE
+    ]
+    return min(adequate, key=lambda name: usable[name]["seconds"])
+
+
+def profile_pdf(file_path: str, max_pages: int = None) -> dict:
+    """Times and scores every extractor on (the first max_pages pages of) a PDF."""
+    results = {name: profile_extractor(extract, file_path, max_pages) for name, extract in PDF_EXTRACTORS.items()}
+    return {
+        "file": file_path,
+        "fingerprint": pdf_fingerprint(file_path),
+        "extractors": results,
+        "recommendation": recommend(results),
+    }
+
+
+class StrategyCache:
+    """Learned extractor per PDF fingerprint, persisted as JSON.
+
+    Several processes (server, bulk ingest workers) may share the file: writes are atomic and a
+    miss re-reads it, so a choice learned by one is picked up by the others.
+    """
+
+    def __init__(self, path: str = STRATEGY_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = self._read()
+        self.hits = 0
+        self.misses = 0
+        self.profiles = 0
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, fingerprint: str):
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                self._entries.update(self._read())
+                entry = self._entries.get(fingerprint)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def set(self, fingerprint: str, strategy: str, samples: int = 1):
+        with self._lock:
+            self._entries.update(self._read())
+            self._entries[fingerprint] = {"strategy": strategy, "samples": samples, "updated": int(time.time())}
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(self._entries, f, indent=1, sort_keys=True)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                print(f"DEBUG: Could not save PDF strategy cache: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"families": len(self._entries), "hits": self.hits, "misses": self.misses, "profiles": self.profiles}
+
+
+strategy_cache = StrategyCache()
+
+
+def choose_strategy(file_path: str):
+    """Extractor to try first for this PDF (or 'ocr'); None means the default order."""
+    if STRATEGY_MODE == "off":
+        return None
+    fingerprint = pdf_fingerprint(file_path)
+    if fingerprint is None:
+        # Without producer metadata there is no family to learn for
+        return None
+    entry = strategy_cache.get(fingerprint)
+    if entry is not None:
+        print(f"DEBUG: PDF family '{fingerprint}' -> {entry['strategy']} (cached)")
+        return entry["strategy"]
+    if STRATEGY_MODE != "learn":
+        return None
+
+    report = profile_pdf(file_path, max_pages=PROFILE_PAGES)
+    strategy_cache.profiles += 1
+    if report["recommendation"]:
+        strategy_cache.set(fingerprint, report["recommendation"])
+    print(f"DEBUG: PDF family '{fingerprint}' profiled -> {report['recommendation']}")
+    return report["recommendation"]
+
+
+def strategy_stats():
+    return strategy_cache.stats()
+
+
+def print_report(report: dict):
+    print(f"--- {report['file']} ({report['fingerprint'] or 'no producer metadata'}) ---")
+    print(f"{'extractor':<12} {'ms/page':>9} {'max ms':>8} {'empty':>7} {'garbled':>8} {'chars':>9}")
+    for name, r in report["extractors"].items():
+        if r.get("error"):
+            print(f"{name:<12} failed: {r['error']}")
+            continue
+        ms = f"{r['ms_per_page']:.1f}" if r["ms_per_page"] is not None else "-"
+        worst = f"{max(r['page_ms']):.1f}" if r["page_ms"] else "-"
+        print(f"{name:<12} {ms:>9} {worst:>8} {r['empty_pages']:>3}/{r['pages']:<3} {r['garbled_ratio']:>7.1%} {r['chars']:>9}")
+    print(f"Recommended: {report['recommendation'] or 'none (every extractor failed)'}")
+
+
+def find_pdfs(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.lower().endswith(".pdf"):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile PDF text extractors and recommend one per document family")
+    parser.add_argument("paths", nargs="+", help="PDF files or directories")
+    parser.add_argument("--pages", type=int, default=None, help="Only profile the first N pages of each file")
+    parser.add_argument("--save", action="store_true", help=f"Store the recommendation per family in {STRATEGY_CACHE_PATH}")
+    parser.add_argument("--json", action="store_true", help="Print the raw reports as JSON lines")
+    args = parser.parse_args()
+
+    by_family = {}
+    for path in find_pdfs(args.paths):
+        report = profile_pdf(path, max_pages=args.pages)
+        if args.json:
+            print(json.dumps(report))
+        else:
+            print_report(report)
+        if report["fingerprint"] and report["recommendation"]:
+            by_family.setdefault(report["fingerprint"], Counter())[report["recommendation"]] += 1
+
+    if by_family:
+        print("\n--- Recommendations by family ---")
+        for fingerprint, votes in sorted(by_family.items()):
+            strategy, count = votes.most_common(1)[0]
+            print(f"{fingerprint}: {strategy} ({count}/{sum(votes.values())} files)")
+            if args.save:
+                strategy_cache.set(fingerprint, strategy, samples=sum(votes.values()))
+        if args.save:
+            print(f"Saved to {STRATEGY_CACHE_PATH}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import os
+import threading
+
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+
+# Prompt layout for provider prompt caching.
+# Providers reuse the longest identical prefix of a request: OpenAI and Gemini automatically,
+# Anthropic up to explicit cache_control breakpoints. So whatever stays the same across the turns
+# of a conversation (the system text, then the history) goes first and is byte-for-byte identical
+# every time, and whatever changes per request (retrieved context, search results, the deep-think
+# instruction) travels with the new question at the very end.
+# Cached versus uncached input tokens are read back from each response.
+
+PROMPT_CACHE = os.getenv("FREEGPT_PROMPT_CACHE", "on").lower() not in ("0", "off", "false", "no")
+
+DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant."
+RAG_INSTRUCTIONS = (
+    " Use the retrieved context given with the question to answer it. "
+    "The context contains information from uploaded files. "
+    "If the context is empty or irrelevant, say that you don't have enough information from the uploaded files. "
+    "Use three sentences maximum and keep the answer concise."
+)
+DEEP_THINK_INSTRUCTION = "Please use a step-by-step reasoning approach and think deeply before providing the final answer."
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def supports_cache_control(model_name: str, base_url: str = None) -> bool:
+    """Native Anthropic models take explicit breakpoints; the others cache prefixes on their own."""
+    return PROMPT_CACHE and model_name.lower().startswith("claude") and not base_url
+
+
+def system_text(system_instruction: str = None, rag: bool = False) -> str:
+    return (system_instruction or DEFAULT_SYSTEM_PROMPT) + (RAG_INSTRUCTIONS if rag else "")
+
+
+def history_messages(history, query: str):
+    """Converts the client's history dicts to LangChain messages."""
+    messages = []
+    for msg in history or []:
+        if msg.get('role') == 'user':
+            # Skip the very last message if it matches the current query (to avoid duplication)
+            if msg.get('content') == query and msg is history[-1]:
+                continue
+            messages.append(HumanMessage(content=msg.get('content', '')))
+        elif msg.get('role') == 'model':
+            messages.append(AIMessage(content=msg.get('content', '')))
+    return messages
+
+
+def _with_breakpoint(message):
+    content = message.content
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = [dict(block) for block in content]
+    content[-1]["cache_control"] = CACHE_CONTROL
+    return message.__class__(content=content)
+
+
+def build_messages(query: str, system_instruction: str = None, history=None, image: str = None,
+                   context: str = None, search_context: str = "", deep_think: bool = False,
+                   cache_breakpoints: bool = False, system_as_human: bool = False):
+    """Stable prefix (system text, history) first, then the question with this request's extras.
+
+    context=None means no retrieval for this request; an empty string means nothing was found.
+    With cache_breakpoints the end of the system text and of the history are marked for Anthropic.
+    system_as_human sends the system text as a leading human message, for providers that don't
+    support a system role.
+    """
+    system_class = HumanMessage if system_as_human else SystemMessage
+    system = system_class(content=system_text(system_instruction, rag=context is not None))
+    history = history_messages(history, query)
+
+    volatile = []
+    if context is not None:
+        volatile.append(f"Retrieved context:\n{context}")
+    if search_context.strip():
+        volatile.append(search_context.strip())
+    if deep_think:
+        volatile.append(DEEP_THINK_INSTRUCTION)
+    text = "\n\n".join(volatile + [f"Question: {query}" if volatile else query])
+
+    if image:
+        # LangChain expects "image_url" even for base64 data URLs
+        content = [{"type": "text", "text": text}, {"type": "image_url", "image_url": {"url": image}}]
+    else:
+        content = text
+
+    if cache_breakpoints:
+        system = _with_breakpoint(system)
+        if history:
+            history[-1] = _with_breakpoint(history[-1])
+    return [system, *history, HumanMessage(content=content)]
+
+
+def usage_report(response) -> dict:
+    """Input tokens split into cached and uncached, from LangChain's usage metadata."""
+    usage = getattr(response, "usage_metadata", None) or {}
+    details = usage.get("input_token_details") or {}
+    input_tokens = usage.get("input_tokens") or 0
+    cached = details.get("cache_read") or 0
+    return {
+        "input_tokens": input_tokens,
+        "cached_input_tokens": cached,
+        "uncached_input_tokens": max(0, input_tokens - cached),
+        "cache_write_tokens": details.get("cache_creation") or 0,
+        "output_tokens": usage.get("output_tokens") or 0,
+    }
+
+
+class PromptCacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def record(self, model_name: str, usage: dict):
+        with self._lock:
+            totals = self._models.setdefault(model_name, {
+                "requests": 0, "input_tokens": 0, "cached_input_tokens": 0, "cache_write_tokens": 0, "output_tokens": 0,
+            })
+            totals["requests"] += 1
+            for key in ("input_tokens", "cached_input_tokens", "cache_write_tokens", "output_tokens"):
+                totals[key] += usage[key]
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                model: dict(totals, cache_hit_ratio=round(totals["cached_input_tokens"] / totals["input_tokens"], 3) if totals["input_tokens"] else 0.0)
+                for model, totals in self._models.items()
+            }
+
+
+prompt_cache_stats = PromptCacheStats()
@@ -1,20 +1,28 @@
 import os
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
-from langchain_community.vectorstores import Chroma
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.documents import Document
-from langchain_core.messages import HumanMessage, AIMessage
-from langchain_community.tools.tavily_search import TavilySearchResults
+from langchain_core.messages import HumanMessage
+from http_pool import get_http_client, get_async_http_client
+from admission import (
+    AdmissionRejected, get_scheduler, provider_for, estimate_tokens,
+    PRIORITY_INTERACTIVE, PRIORITY_INGEST, PRIORITY_OCR
+)
+from failover import Candidate, fallbacks_for, hedged_invoke
+from singleflight import chat_flights, request_key
+from partitions import PartitionRouter
+from embeddings import create_embeddings, embed_queries
+from extraction import file_hash, is_supported, iter_pages, iter_chunks
+from images import render_page_for_ocr
+from prompts import build_messages, supports_cache_control, usage_report, prompt_cache_stats
 import base64
-import pypdf
-import docx
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import fitz # pymupdf
-import pdfplumber
 
 # Disable ChromaDB telemetry to fix PyInstaller issues
 os.environ["ANONYMIZED_TELEMETRY"] = "False"
@@ -23,6 +31,23 @@ os.environ["ANONYMIZED_TELEMETRY"] = "False"
 # Use current working directory for persistence (works for both dev and PyInstaller EXE)
 PERSIST_DIRECTORY = os.path.join(os.getcwd(), "chroma_data")
 
+# Chunks embedded and committed per provider call while a document streams in
+INGEST_BATCH_SIZE = int(os.getenv("FREEGPT_INGEST_BATCH", "64"))
+# LLM clients kept per engine (least recently used ones are dropped beyond this)
+LLM_CACHE_SIZE = max(1, int(os.getenv("FREEGPT_LLM_CACHE_SIZE", "32")))
+
+TAVILY_SEARCH_URL = "https://api.tavily.com/search"
+
+def search_web(query: str, api_key: str, max_results: int = 3):
+    """Runs a Tavily search through the shared HTTP pool and returns its result list."""
+    response = get_http_client().post(
+        TAVILY_SEARCH_URL,
+        headers={"Authorization": f"Bearer {api_key}"},
+        json={"api_key": api_key, "query": query, "max_results": max_results},
+    )
+    response.raise_for_status()
+    return response.json().get("results", [])
+
 class RAGEngine:
     def __init__(self, api_key: str, model_name: str = "gemini-1.5-pro", base_url: str = None):
         if not api_key:
@@ -39,43 +64,103 @@ class RAGEngine:
         self.api_key = api_key
         self.current_model_name = model_name
         self.base_url = base_url
+
+        # LLM instances per (model, key hash, base_url) so concurrent requests never swap each other's model
+        self._llm_cache = OrderedDict()
+        self._llm_cache_lock = threading.Lock()
         
-        # Embeddings Selection based on Key Format
+        # Embeddings: explicit FREEGPT_EMBEDDING_PROVIDER, or guessed from the key format
+        self.embedding_provider = None
+        self.embedding_model = None
         try:
-            if api_key.startswith("sk-") and not base_url:
-                # Likely OpenAI
-                print("DEBUG: Using OpenAIEmbeddings")
-                self.embeddings = OpenAIEmbeddings(api_key=api_key)
-            else:
-                # Default to Google (or try Google if generic)
-                # Note: This might fail if it's a non-sk key but not Google.
-                # Ideally, we should require specific env vars for embeddings.
-                print("DEBUG: Using GoogleGenerativeAIEmbeddings")
-                self.embeddings = GoogleGenerativeAIEmbeddings(
-                    model="models/embedding-001", 
-                    google_api_key=api_key
-                )
+            self.embeddings, self.embedding_provider, self.embedding_model = create_embeddings(api_key, base_url)
         except Exception as e:
             print(f"Warning: Failed to initialize embeddings: {e}. RAG features may not work.")
             self.embeddings = None
 
         if self.embeddings:
             try:
-                print("DEBUG: Initializing Chroma Vector Store...")
-                self.vector_store = Chroma(
-                    persist_directory=PERSIST_DIRECTORY,
-                    embedding_function=self.embeddings,
-                    collection_name="my_knowledge_base"
-                )
-                print("DEBUG: Chroma initialized successfully.")
+                print("DEBUG: Initializing Vector Store...")
+                self.vector_store = PartitionRouter(self.embeddings, PERSIST_DIRECTORY, embedding_model=self.embedding_model)
+                print(f"DEBUG: Vector store initialized successfully (backend: {self.vector_store.name}).")
             except Exception as e:
-                print(f"Error initializing Vector Store (Chroma): {e}. RAG disabled.")
+                print(f"Error initializing Vector Store: {e}. RAG disabled.")
                 self.vector_store = None
         else:
             print("DEBUG: No embeddings, RAG disabled.")
             self.vector_store = None
         
-        self.llm = self._create_llm(model_name, api_key, base_url)
+        self.llm = self._get_llm(model_name, api_key, base_url)
+
+    def _get_llm(self, model_name: str, api_key: str, base_url: str = None):
+        """Returns a cached LLM instance for the given configuration, creating it on first use."""
+        # Keys are hashed so the cache never holds a client's raw key as a dict key
+        cache_key = (model_name, hashlib.sha256((api_key or "").encode()).hexdigest(), base_url)
+        with self._llm_cache_lock:
+            llm = self._llm_cache.get(cache_key)
+            if llm is None:
+                llm = self._create_llm(model_name, api_key, base_url)
+                self._llm_cache[cache_key] = llm
+                while len(self._llm_cache) > LLM_CACHE_SIZE:
+                    self._llm_cache.popitem(last=False)
+            else:
+                self._llm_cache.move_to_end(cache_key)
+        return llm
+
+    def _llm_scheduler(self, model_name: str = None, api_key: str = None, base_url: str = None):
+        model_name = model_name or self.current_model_name
+        api_key = api_key or self.api_key
+        return get_scheduler(provider_for(model_name, api_key, base_url), api_key)
+
+    def _embedding_scheduler(self):
+        return get_scheduler(self.embedding_provider, self.api_key)
+
+    def _generate(self, messages, model_name: str, api_key: str, base_url: str = None, priority: int = PRIORITY_INTERACTIVE, tokens: int = 0):
+        """Invokes the LLM, hedging across the model's fallback chain when one is configured."""
+        llm = self._get_llm(model_name, api_key, base_url)
+        scheduler = self._llm_scheduler(model_name, api_key, base_url)
+
+        fallbacks = fallbacks_for(model_name)
+        if not fallbacks:
+            return scheduler.run(lambda: llm.invoke(messages), priority=priority, tokens=tokens)
+
+        candidates = [Candidate(f"{provider_for(model_name, api_key, base_url)}/{model_name}", llm, scheduler)]
+        for fb_model, fb_key, fb_base_url in fallbacks:
+            candidates.append(Candidate(
+                f"{provider_for(fb_model, fb_key, fb_base_url)}/{fb_model}",
+                self._get_llm(fb_model, fb_key, fb_base_url),
+                self._llm_scheduler(fb_model, fb_key, fb_base_url)
+            ))
+        return hedged_invoke(candidates, messages, priority, tokens)
+
+    def warm_up(self):
+        """Opens the vector store and primes provider connections so the first request is not cold."""
+        print("DEBUG: Warming up RAGEngine...")
+
+        # Touch the collection so the store loads its metadata and index segments
+        if self.vector_store is not None:
+            try:
+                count = self.vector_store.count()
+                print(f"DEBUG: Warm-up - Vector store opened ({count} chunks).")
+            except Exception as e:
+                print(f"Warning: Warm-up could not open vector store: {e}")
+
+        # A one-word embedding opens the TLS connection the embeddings client will reuse
+        if self.embeddings is not None:
+            try:
+                self.embeddings.embed_query("warmup")
+                print("DEBUG: Warm-up - Embeddings provider reachable.")
+            except Exception as e:
+                print(f"Warning: Warm-up embeddings call failed: {e}")
+
+        # Listing models is free and goes through the same HTTP client as chat completions
+        root_client = getattr(self.llm, "root_client", None)
+        if root_client is not None:
+            try:
+                root_client.models.list()
+                print("DEBUG: Warm-up - LLM provider connection established.")
+            except Exception as e:
+                print(f"Warning: Warm-up LLM connection failed: {e}")
 
     def _create_llm(self, model_name: str, api_key: str, base_url: str = None):
         """Creates the LLM instance based on model name and provider config."""
@@ -101,7 +186,12 @@ class RAGEngine:
             kwargs = {
                 "model": model_name,
                 "api_key": api_key,
-                "request_timeout": 60 # Prevent infinite hanging
+                "request_timeout": 60, # Prevent infinite hanging
+                # Shared keep-alive pool so recreating the LLM doesn't redo DNS/TLS
+                "http_client": get_http_client(),
+                "http_async_client": get_async_http_client(),
+                # Hedged requests stream; without this, custom base_url streams carry no token usage
+                "stream_usage": True
             }
             
             # Special handling for reasoning models or models that reject temp=0
@@ -117,13 +207,13 @@ class RAGEngine:
                 
             return ChatOpenAI(**kwargs)
 
-    def perform_ocr(self, image_bytes):
+    def perform_ocr(self, image_bytes, mime_type: str = "image/png"):
         """Uses the current LLM to perform OCR on an image."""
         print("DEBUG: Performing OCR with LLM...")
         try:
             # Encode image to base64
             b64_image = base64.b64encode(image_bytes).decode('utf-8')
-            image_data_url = f"data:image/png;base64,{b64_image}"
+            image_data_url = f"data:{mime_type};base64,{b64_image}"
             
             prompt = "Transcribe the text in this image exactly. Do not add any commentary. Output only the text content."
             
@@ -134,132 +224,128 @@ class RAGEngine:
                 ]
             )
             
-            response = self.llm.invoke([message])
+            scheduler = self._llm_scheduler(base_url=self.base_url)
+            response = scheduler.run(lambda: self.llm.invoke([message]), priority=PRIORITY_OCR, tokens=estimate_tokens(prompt) + 1000)
             return response.content
+        except AdmissionRejected:
+            raise
         except Exception as e:
             print(f"OCR Failed: {e}")
             return ""
 
-    def ingest_text(self, text: str, source: str = "manual_input", session_id: str = None):
+    def ingest_text(self, text: str, source: str = "manual_input", session_id: str = None, content_hash: str = None):
         """Splits and indexes text into the vector store."""
         print(f"DEBUG: ingest_text called for source: {source}. Text length: {len(text)}")
+        return self.ingest_chunks(iter_chunks([(None, text)]), source, session_id=session_id, content_hash=content_hash)
+
+    def ingest_chunks(self, chunks, source: str, session_id: str = None, content_hash: str = None):
+        """Embeds and commits a stream of (chunk, page_number) in batches as they fill up.
+
+        Each batch is searchable as soon as it is written, and only one batch is held in memory.
+        Returns the number of chunks stored. If extraction, embedding or admission fails midway,
+        the batches already written are deleted again and the error is raised.
+        """
         if self.vector_store is None:
             print("DEBUG: Vector store is None. Skipping ingestion.")
             return 0
-            
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        chunks = text_splitter.split_text(text)
-        print(f"DEBUG: Text split into {len(chunks)} chunks.")
-        
-        metadata = {"source": source}
+
+        metadata = {"source": source, "ingested_at": int(time.time())}
         if session_id:
             metadata["session_id"] = session_id
+        if content_hash:
+            metadata["content_hash"] = content_hash
 
-        documents = [Document(page_content=chunk, metadata=metadata) for chunk in chunks]
-        
-        if documents:
-            try:
-                print(f"DEBUG: Adding {len(documents)} documents to vector store...")
-                self.vector_store.add_documents(documents)
-                # Try to force persist if method exists (older versions)
-                if hasattr(self.vector_store, 'persist'):
-                    print("DEBUG: Persisting vector store...")
-                    self.vector_store.persist()
-                print("DEBUG: Documents added successfully.")
-                return len(documents)
-            except Exception as e:
-                print(f"ERROR: Failed to add documents to vector store: {e}")
-                return 0
+        stored = 0
+        batch = []
+        committed_ids = []
+
+        def commit():
+            ids = [uuid.uuid4().hex for _ in batch]
+            texts = [chunk for chunk, _ in batch]
+            metadatas = [dict(metadata, page=page) if page is not None else dict(metadata) for _, page in batch]
+            count = self.add_chunks(ids, texts, metadatas, session_id=session_id)
+            committed_ids.extend(ids)
+            return count
+
+        try:
+            for chunk, page in chunks:
+                batch.append((chunk, page))
+                if len(batch) >= INGEST_BATCH_SIZE:
+                    stored += commit()
+                    batch = []
+                    print(f"DEBUG: Committed {stored} chunks of {source}...")
+            if batch:
+                stored += commit()
+        except BaseException as e:
+            print(f"ERROR: Ingestion of {source} failed after {stored} chunks: {e}")
+            if committed_ids:
+                # A half-ingested document would look complete; remove it so a retry starts clean
+                try:
+                    self.vector_store.delete(ids=committed_ids)
+                except Exception as cleanup_error:
+                    print(f"ERROR: Could not remove the partial chunks of {source}: {cleanup_error}")
+            raise
+
+        if stored:
+            print(f"DEBUG: Added {stored} chunks of {source} to vector store.")
         else:
-             print("DEBUG: No documents created from text.")
-        return 0
+            print("DEBUG: No documents created from text.")
+        return stored
+
+    def add_chunks(self, ids, texts, metadatas, session_id: str = None, priority: int = PRIORITY_INGEST):
+        """Embeds a batch of chunks with one provider call and writes them to the store."""
+        if self.vector_store is None:
+            return 0
+        vectors = self._embedding_scheduler().run(
+            lambda: self.embeddings.embed_documents(list(texts)),
+            priority=priority,
+            tokens=estimate_tokens(texts)
+        )
+        return self.vector_store.add_embedded(ids, vectors, texts, metadatas, session_id=session_id)
+
+    def iter_ocr_pages(self, file_path: str, max_pages: int = 5):
+        """Transcribes the first pages of a scanned PDF with the LLM's vision capability, page by page."""
+        doc = None
+        try:
+            doc = fitz.open(file_path)
+            for i, page in enumerate(doc):
+                # Limit to first pages to prevent timeouts/high costs
+                if i >= max_pages:
+                    print(f"DEBUG: Reached page limit ({max_pages}) for OCR.")
+                    break
+                    
+                # Render page to a grayscale JPEG sized for the model
+                img_bytes, mime_type = render_page_for_ocr(page, self.current_model_name)
+                
+                print(f"DEBUG: OCR Processing page {i+1}/{len(doc)} ({len(img_bytes) // 1024} KB)...")
+                yield i + 1, self.perform_ocr(img_bytes, mime_type) + "\n"
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            print(f"DEBUG: OCR failed: {e}")
+        finally:
+            if doc:
+                doc.close()
 
     def ingest_file(self, file_path: str, source: str, session_id: str = None):
         """Extracts text from file and indexes it."""
         print(f"DEBUG: ingest_file called for {source} at {file_path}")
-        text = ""
-        ext = os.path.splitext(source)[1].lower()
+        if not is_supported(source):
+            print(f"DEBUG: Unsupported file extension: {os.path.splitext(source)[1].lower()}")
+            return 0 # Unsupported file type
         
         try:
-            if ext == ".pdf":
-                print("DEBUG: Processing PDF with pypdf...")
-                try:
-                    reader = pypdf.PdfReader(file_path)
-                    for i, page in enumerate(reader.pages):
-                        page_text = page.extract_text()
-                        if page_text:
-                            text += page_text + "\n"
-                except Exception as e:
-                    print(f"DEBUG: pypdf failed: {e}")
-
-                # Fallback 1: PyMuPDF (fitz)
-                if not text.strip():
-                    print("DEBUG: pypdf yielded empty text. Trying PyMuPDF (fitz)...")
-                    doc = None
-                    try:
-                        doc = fitz.open(file_path)
-                        for page in doc:
-                            text += page.get_text() + "\n"
-                    except Exception as e:
-                        print(f"DEBUG: PyMuPDF failed: {e}")
-                    finally:
-                        if doc:
-                            doc.close()
-                
-                # Fallback 2: pdfplumber
-                if not text.strip():
-                     print("DEBUG: PyMuPDF yielded empty text. Trying pdfplumber...")
-                     try:
-                        with pdfplumber.open(file_path) as pdf:
-                            for page in pdf.pages:
-                                page_text = page.extract_text()
-                                if page_text:
-                                    text += page_text + "\n"
-                     except Exception as e:
-                        print(f"DEBUG: pdfplumber failed: {e}")
-
-                # Fallback 3: LLM Vision OCR (if text is still empty)
-                if not text.strip() and self.llm:
-                     print("DEBUG: Text extraction failed. Attempting OCR with LLM Vision...")
-                     doc = None
-                     try:
-                        doc = fitz.open(file_path)
-                        for i, page in enumerate(doc):
-                            # Limit to first 5 pages to prevent timeouts/high costs
-                            if i >= 5:
-                                print("DEBUG: Reached page limit (5) for OCR.")
-                                break
-                                
-                            # Render page to image
-                            pix = page.get_pixmap()
-                            img_bytes = pix.tobytes("png")
-                            
-                            print(f"DEBUG: OCR Processing page {i+1}/{len(doc)}...")
-                            page_text = self.perform_ocr(img_bytes)
-                            text += page_text + "\n"
-                     except Exception as e:
-                        print(f"DEBUG: OCR failed: {e}")
-                     finally:
-                        if doc:
-                            doc.close()
-
-            elif ext == ".docx":
-                print("DEBUG: Processing DOCX...")
-                doc = docx.Document(file_path)
-                text = "\n".join([para.text for para in doc.paragraphs])
-            elif ext == ".txt":
-                print("DEBUG: Processing TXT...")
-                with open(file_path, "r", encoding="utf-8") as f:
-                    text = f.read()
-            else:
-                print(f"DEBUG: Unsupported file extension: {ext}")
-                return 0 # Unsupported file type
+            content_hash = file_hash(file_path)
+            count = self.ingest_chunks(iter_chunks(iter_pages(file_path, source)), source, session_id=session_id, content_hash=content_hash)
+
+            # Fallback 3: LLM Vision OCR (if no text could be extracted)
+            if count == 0 and source.lower().endswith(".pdf") and self.llm:
+                print("DEBUG: Text extraction failed. Attempting OCR with LLM Vision...")
+                count = self.ingest_chunks(iter_chunks(self.iter_ocr_pages(file_path)), source, session_id=session_id, content_hash=content_hash)
             
-            print(f"DEBUG: Extracted total text length: {len(text)}")
-            if len(text.strip()) == 0:
+            if count == 0:
                  print("DEBUG: Warning - Extracted text is empty! File might be an image/scan.")
-                
-            return self.ingest_text(text, source, session_id=session_id)
+            return count
         except Exception as e:
             print(f"Error processing file {source}: {e}")
             raise e
@@ -273,21 +359,9 @@ class RAGEngine:
         try:
             # Get all metadata to find unique sources
             print("DEBUG: list_documents - Fetching from vector_store...")
-            data = self.vector_store.get()
-            
-            if not data or not data['metadatas']:
-                print("DEBUG: list_documents - No metadata found in DB.")
-                return []
-            
-            print(f"DEBUG: list_documents - Found {len(data['metadatas'])} chunks.")
-            
-            sources = set()
-            for metadata in data['metadatas']:
-                if metadata and 'source' in metadata:
-                    sources.add(metadata['source'])
-            
-            print(f"DEBUG: list_documents - Unique sources: {list(sources)}")
-            return list(sources)
+            sources = self.vector_store.list_sources()
+            print(f"DEBUG: list_documents - Unique sources: {sources}")
+            return sources
         except Exception as e:
             print(f"Error listing documents: {e}")
             return []
@@ -298,47 +372,63 @@ class RAGEngine:
             return False
             
         try:
-            # ChromaDB delete by metadata
-            # Note: LangChain's Chroma wrapper might not expose delete with where clause easily in all versions,
-            # but usually it forwards to the underlying client or we can use _collection.
-            
-            # Using the underlying collection to be safe and efficient
-            self.vector_store._collection.delete(where={"source": source})
+            self.vector_store.delete({"source": source})
             return True
         except Exception as e:
             print(f"Error deleting document {source}: {e}")
             return False
 
+    def delete_session_knowledge(self, session_id: str):
+        """Deletes every chunk ingested for a chat session."""
+        if self.vector_store is None:
+            return False
+        try:
+            return self.vector_store.drop_session(session_id)
+        except Exception as e:
+            print(f"Error deleting knowledge for session {session_id}: {e}")
+            return False
+
     def get_response(self, query: str, image: str = None, model_name: str = None, base_url: str = None, api_key: str = None, history: list = None, deep_think: bool = False, enable_search: bool = False, search_api_key: str = None, system_instruction: str = None, session_id: str = None):
-        """Retrieves context and generates a response."""
-        
-        # Use provided key or fallback to stored key
+        """Retrieves context and generates a response, coalescing identical concurrent requests."""
         effective_key = api_key or self.api_key
-
-        # Update LLM if model, base_url, or KEY changed
-        config_changed = (
-            (model_name and model_name != self.current_model_name) or 
-            (base_url and base_url != self.base_url) or
-            (effective_key != self.api_key) # Check if key changed
+        key = request_key(
+            query,
+            hashlib.sha256(image.encode()).hexdigest() if image else None,
+            model_name or self.current_model_name,
+            base_url or self.base_url,
+            hashlib.sha256(effective_key.encode()).hexdigest(),
+            history,
+            deep_think,
+            enable_search,
+            # Different Tavily keys must not share one search (and one client's quota)
+            hashlib.sha256(search_api_key.encode()).hexdigest() if enable_search and search_api_key else None,
+            system_instruction,
+            session_id
         )
+        response, shared = chat_flights.do(key, lambda: self._get_response(
+            query, image=image, model_name=model_name, base_url=base_url, api_key=api_key,
+            history=history, deep_think=deep_think, enable_search=enable_search,
+            search_api_key=search_api_key, system_instruction=system_instruction, session_id=session_id
+        ))
+        if shared:
+            print(f"DEBUG: Coalesced chat request onto an identical in-flight request: {query[:50]}...")
+            return dict(response)
+        return response
+
+    def _get_response(self, query: str, image: str = None, model_name: str = None, base_url: str = None, api_key: str = None, history: list = None, deep_think: bool = False, enable_search: bool = False, search_api_key: str = None, system_instruction: str = None, session_id: str = None):
+        """Retrieves context and generates a response."""
         
-        if config_changed:
-            target_model = model_name or self.current_model_name
-            target_base_url = base_url or self.base_url
-            
-            self.llm = self._create_llm(target_model, effective_key, target_base_url)
-            self.current_model_name = target_model
-            self.base_url = target_base_url
-            self.api_key = effective_key # Update stored key
+        # Per-request model, key and base URL, falling back to the engine's own. They are only passed
+        # down, never stored on the engine, so OCR and concurrent requests keep their configuration
+        effective_key = api_key or self.api_key
+        target_model = model_name or self.current_model_name
+        target_base_url = base_url or self.base_url
 
         # Search Logic
         search_context = ""
         if enable_search and search_api_key:
             try:
-                # Set environment variable temporarily for the tool
-                os.environ["TAVILY_API_KEY"] = search_api_key
-                tool = TavilySearchResults(max_results=3)
-                search_results = tool.invoke({"query": query})
+                search_results = search_web(query, search_api_key, max_results=3)
                 
                 # Format results into a context string
                 formatted_results = "\n\n--- INTERNET SEARCH RESULTS ---\n"
@@ -352,40 +442,23 @@ class RAGEngine:
                 print(f"Internet Search failed: {e}")
                 search_context = "\n[Internet Search Attempted but Failed]\n"
 
-        # Add reasoning instruction if Deep Think is enabled
-        reasoning_instruction = ""
-        if deep_think:
-            reasoning_instruction = " Please use a step-by-step reasoning approach and think deeply before providing the final answer."
-
-        # Base System Prompt
-        base_system_prompt = system_instruction if system_instruction else "You are a helpful assistant."
-        
-        # Convert history dicts to LangChain Message objects
-        chat_history = []
-        if history:
-            for msg in history:
-                # Skip the very last message if it matches the current query (to avoid duplication)
-                if msg.get('role') == 'user':
-                    if msg.get('content') == query and msg is history[-1]:
-                         continue
-                    chat_history.append(HumanMessage(content=msg.get('content', '')))
-                elif msg.get('role') == 'model':
-                    chat_history.append(AIMessage(content=msg.get('content', '')))
+        cache_breakpoints = self._cache_breakpoints(target_model, target_base_url)
+        prefix_tokens = estimate_tokens([system_instruction or ""] + [msg.get('content', '') for msg in history or []])
 
         # If we have a vector store, use RAG. Otherwise just chat.
         if self.vector_store is not None and not image: # Disable RAG if image is present (simplified logic)
             print("DEBUG: Attempting RAG retrieval...")
             try:
-                # Apply Session Filter if provided
-                search_kwargs = {"k": 5}
+                # Session chats only search that session's knowledge
                 if session_id:
-                    print(f"DEBUG: Filtering RAG by session_id: {session_id}")
-                    search_kwargs["filter"] = {"session_id": session_id}
-
-                retriever = self.vector_store.as_retriever(search_kwargs=search_kwargs)
+                    print(f"DEBUG: Scoping RAG to session_id: {session_id}")
                 
-                # Retrieve documents manually first to debug
-                retrieved_docs = retriever.invoke(query)
+                # Retrieve once here; the documents are stuffed into the prompt below
+                retrieved_docs = self._embedding_scheduler().run(
+                    lambda: self.vector_store.similarity_search(query, k=5, session_id=session_id),
+                    priority=PRIORITY_INTERACTIVE,
+                    tokens=estimate_tokens(query)
+                )
                 print(f"DEBUG: Retrieved {len(retrieved_docs)} documents.")
                 for i, doc in enumerate(retrieved_docs):
                     print(f"DEBUG: Doc {i} source: {doc.metadata.get('source', 'unknown')}")
@@ -394,38 +467,24 @@ class RAGEngine:
                 if not retrieved_docs:
                      print("DEBUG: No relevant documents found via RAG.")
                 
-                system_prompt = (
-                    f"{base_system_prompt} "
-                    "Use the following pieces of retrieved context to answer "
-                    "the question. The context contains information from uploaded files. "
-                    "If the context is empty or irrelevant, say that you don't have enough information from the uploaded files. "
-                    "Use three sentences maximum and keep the answer concise."
-                    + reasoning_instruction +
-                    "\n\n"
-                    "{context}"
-                    + search_context
+                context = "\n\n".join(doc.page_content for doc in retrieved_docs)
+                messages = build_messages(
+                    query, system_instruction, history, context=context, search_context=search_context,
+                    deep_think=deep_think, cache_breakpoints=cache_breakpoints
                 )
                 
-                prompt = ChatPromptTemplate.from_messages(
-                    [
-                        ("system", system_prompt),
-                        MessagesPlaceholder(variable_name="chat_history"),
-                        ("human", "{input}"),
-                    ]
+                response = self._generate(
+                    messages, target_model, effective_key, target_base_url,
+                    priority=PRIORITY_INTERACTIVE,
+                    tokens=estimate_tokens([query, context, search_context]) + prefix_tokens
                 )
                 
-                question_answer_chain = create_stuff_documents_chain(self.llm, prompt)
-                rag_chain = create_retrieval_chain(retriever, question_answer_chain)
-                
-                response = rag_chain.invoke({
-                    "input": query,
-                    "chat_history": chat_history
-                })
-                
                 # Extract sources
                 sources = list(set([doc.metadata.get('source', 'Unknown') for doc in retrieved_docs]))
                 
-                return {"answer": response["answer"], "sources": sources}
+                return {"answer": response.content, "sources": sources, "usage": self._record_usage(target_model, response)}
+            except AdmissionRejected:
+                raise
             except Exception as e:
                 print(f"RAG Retrieval failed: {e}. Fallback to direct chat.")
                 pass
@@ -435,34 +494,96 @@ class RAGEngine:
         # Fallback to direct chat (or Image Chat)
         print(f"Invoking LLM (DeepThink: {deep_think}, Search: {enable_search}, Image: {bool(image)}) with query: {query[:50]}...")
         try:
-            # Construct message content
-            if image:
-                # Assuming image is base64 data string (e.g. "data:image/png;base64,.....")
-                # LangChain expects "image_url" key even for base64 data
-                content = [
-                    {"type": "text", "text": query},
-                    {"type": "image_url", "image_url": {"url": image}} 
-                ]
-                # Note: This works for OpenAI and some others. 
-                # For Gemini via LangChain, it might need specific handling if it doesn't support standard content blocks.
-                # However, langchain-google-genai usually handles it.
-            else:
-                content = query
-
-            # Construct prompt with history and search context
-            # System prompt
-            system_msg = base_system_prompt + reasoning_instruction + "\n" + search_context
-            
-            messages = [
-                HumanMessage(content=system_msg), # Passing system instruction as HumanMessage first for better compat if system not supported
-                *chat_history,
-                HumanMessage(content=content)
-            ]
+            # The instructions go first as a HumanMessage for better compat if system is not supported
+            messages = build_messages(
+                query, system_instruction, history, image=image, search_context=search_context,
+                deep_think=deep_think, cache_breakpoints=cache_breakpoints, system_as_human=True
+            )
             
-            response = self.llm.invoke(messages)
+            response = self._generate(
+                messages, target_model, effective_key, target_base_url,
+                priority=PRIORITY_INTERACTIVE,
+                tokens=estimate_tokens([query, search_context]) + prefix_tokens
+            )
             
             print("LLM invocation successful.")
-            return {"answer": response.content, "sources": []}
+            return {"answer": response.content, "sources": [], "usage": self._record_usage(target_model, response)}
         except Exception as e:
             print(f"LLM invocation failed: {e}")
             raise e
+
+    def answer_batch(self, queries: list, model_name: str = None, base_url: str = None, api_key: str = None, system_instruction: str = None, session_id: str = None, deep_think: bool = False, k: int = 5, max_concurrency: int = None):
+        """Answers independent questions against the knowledge base; returns an iterator of results in completion order.
+
+        All queries are embedded in one call and retrieved in one vectorised search before this
+        returns. Generation then runs concurrently within the provider's concurrency limit, at
+        ingest priority so interactive chat is served first.
+        """
+        effective_key = api_key or self.api_key
+        target_model = model_name or self.current_model_name
+        target_base_url = base_url or self.base_url
+
+        contexts = [None] * len(queries)
+        sources = [[] for _ in queries]
+        if self.vector_store is not None and queries:
+            try:
+                vectors = self._embedding_scheduler().run(
+                    lambda: embed_queries(self.embeddings, queries),
+                    priority=PRIORITY_INGEST,
+                    tokens=estimate_tokens(queries)
+                )
+                for i, docs in enumerate(self.vector_store.similarity_search_by_vectors(vectors, k=k, session_id=session_id)):
+                    contexts[i] = "\n\n".join(doc.page_content for doc in docs)
+                    sources[i] = list(set(doc.metadata.get('source', 'Unknown') for doc in docs))
+                print(f"DEBUG: Batch retrieval done for {len(queries)} queries.")
+            except AdmissionRejected:
+                raise
+            except Exception as e:
+                print(f"Batch RAG retrieval failed: {e}. Answering without context.")
+
+        cache_breakpoints = self._cache_breakpoints(target_model, target_base_url)
+        scheduler = self._llm_scheduler(target_model, effective_key, target_base_url)
+        # More threads than admission slots would only fill the provider queue
+        workers = max(1, min(max_concurrency or scheduler.max_concurrency, scheduler.max_concurrency, len(queries) or 1))
+
+        def answer(i):
+            messages = build_messages(
+                queries[i], system_instruction, context=contexts[i], deep_think=deep_think, cache_breakpoints=cache_breakpoints
+            )
+            response = self._generate(
+                messages, target_model, effective_key, target_base_url,
+                priority=PRIORITY_INGEST,
+                tokens=estimate_tokens([system_instruction or "", queries[i], contexts[i] or ""])
+            )
+            return {"index": i, "query": queries[i], "answer": response.content, "sources": sources[i], "usage": self._record_usage(target_model, response)}
+
+        def results():
+            pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat-batch")
+            try:
+                futures = {pool.submit(answer, i): i for i in range(len(queries))}
+                for future in as_completed(futures):
+                    i = futures[future]
+                    try:
+                        yield future.result()
+                    except AdmissionRejected as e:
+                        yield {"index": i, "query": queries[i], "error": str(e), "retry_after": e.retry_after}
+                    except Exception as e:
+                        print(f"Batch item {i} failed: {e}")
+                        yield {"index": i, "query": queries[i], "error": str(e)}
+            finally:
+                # The client may stop reading early; don't run the remaining questions for nobody
+                pool.shutdown(wait=False, cancel_futures=True)
+
+        return results()
+
+    def _cache_breakpoints(self, model_name: str, base_url: str = None) -> bool:
+        # Anthropic needs explicit cache breakpoints; only add them if every model that may answer understands them
+        return supports_cache_control(model_name, base_url) and all(
+            supports_cache_control(fb_model, fb_base_url) for fb_model, _, fb_base_url in fallbacks_for(model_name)
+        )
+
+    def _record_usage(self, model_name: str, response) -> dict:
+        usage = usage_report(response)
+        prompt_cache_stats.record(model_name, usage)
+        print(f"DEBUG: Input tokens {usage['input_tokens']} ({usage['cached_input_tokens']} cached, {usage['cache_write_tokens']} written to cache).")
+        return usage
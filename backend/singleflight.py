@@ -0,0 +1,83 @@
+import os
+import json
+import hashlib
+import threading
+
+# Single-flight coalescing: concurrent identical calls share one in-flight computation.
+# The first caller (the leader) runs the work; callers arriving while it runs wait for and
+# receive the same result or exception instead of repeating retrieval and the provider call.
+
+ENABLED = os.getenv("FREEGPT_SINGLE_FLIGHT", "true").lower() in ("1", "true", "yes")
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn):
+        """Runs fn once per key at a time; returns (result, shared) where shared means it was coalesced."""
+        if not ENABLED:
+            return fn(), False
+
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        if call.waiters:
+            print(f"DEBUG: Single-flight result fanned out to {call.waiters} waiting request(s).")
+        return call.result, False
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._calls)
+        return {
+            "enabled": ENABLED,
+            "in_flight": in_flight,
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "provider_calls_saved": self.coalesced,
+        }
+
+
+def request_key(*parts) -> str:
+    """Stable hash of the JSON-serialisable parts that determine a response."""
+    raw = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# Shared by every RAGEngine instance; the API key is part of the request key
+chat_flights = SingleFlight()
@@ -0,0 +1,141 @@
+import os
+import re
+import sys
+import gzip
+import mimetypes
+
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.staticfiles import StaticFiles
+
+# Frontend and download serving helpers.
+# The built frontend is precompressed once (gzip, plus brotli when the 'brotli' package is
+# installed) and served with the encoding the browser accepts. Vite's content-hashed assets never
+# change under the same name, so they are cached as immutable; index.html is always revalidated.
+# API responses are gzipped on the fly above a size threshold.
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+API_GZIP_MIN_SIZE = int(os.getenv("FREEGPT_GZIP_MIN_SIZE", "1024"))
+
+COMPRESSIBLE_EXTENSIONS = (".js", ".mjs", ".css", ".html", ".svg", ".json", ".map", ".txt", ".xml", ".wasm", ".ico")
+# Vite names bundles like index-BdF3x9aZ.js
+HASHED_ASSET = re.compile(r"[-.][A-Za-z0-9_-]{8,}\.[A-Za-z0-9]+$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+def accepted_encodings(accept_encoding: str) -> dict:
+    """Parses Accept-Encoding into {coding: q}."""
+    weights = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding] = q
+    return weights
+
+
+def encoding_weight(weights: dict, encoding: str) -> float:
+    """q of an encoding, falling back to '*'; 0 means not acceptable."""
+    return weights.get(encoding, weights.get("*", 0.0))
+
+
+def _write_if_stale(source: str, target: str, compress) -> bool:
+    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+        return False
+    with open(source, "rb") as f:
+        data = compress(f.read())
+    with open(target + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(target + ".tmp", target)
+    return True
+
+
+def precompress_directory(directory) -> int:
+    """Writes .gz (and .br) siblings for compressible files that lack an up-to-date one."""
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            try:
+                written += _write_if_stale(path, path + ".gz", lambda data: gzip.compress(data, 9, mtime=0))
+                if brotli is not None:
+                    written += _write_if_stale(path, path + ".br", lambda data: brotli.compress(data, quality=11))
+            except OSError as e:
+                # Read-only install; the files are still served, just uncompressed
+                print(f"DEBUG: Could not precompress {path}: {e}")
+                return written
+    return written
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that serves .br/.gz siblings when accepted and sets cache headers."""
+
+    async def get_response(self, path: str, scope):
+        weights = accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+        candidates = [(encoding, suffix) for encoding, suffix in (("br", ".br"), ("gzip", ".gz")) if encoding_weight(weights, encoding) > 0]
+        # Highest q first; brotli wins ties
+        candidates.sort(key=lambda candidate: -encoding_weight(weights, candidate[0]))
+        response = None
+        for encoding, suffix in candidates:
+            try:
+                response = await super().get_response(path + suffix, scope)
+            except HTTPException:
+                continue
+            response.headers["content-encoding"] = encoding
+            # Typed from the original name, not the .br/.gz suffix
+            response.headers["content-type"] = self._media_type(path)
+            break
+        if response is None:
+            response = await super().get_response(path, scope)
+
+        response.headers["vary"] = "Accept-Encoding"
+        response.headers["cache-control"] = IMMUTABLE if HASHED_ASSET.search(path) else REVALIDATE
+        return response
+
+    @staticmethod
+    def _media_type(path: str) -> str:
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if media_type.startswith("text/") or media_type in ("application/javascript", "application/json", "image/svg+xml"):
+            media_type += "; charset=utf-8"
+        return media_type
+
+
+class ApiGZipMiddleware:
+    """GZip for /api responses only; static files are precompressed, downloads and streams pass through."""
+
+    def __init__(self, app, minimum_size: int = API_GZIP_MIN_SIZE):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size, compresslevel=6)
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "") if scope["type"] == "http" else ""
+        # Downloads keep Range support; streamed batch results must not wait in the compressor's buffer
+        # GZipMiddleware only looks for "gzip" in the header, so honour "gzip;q=0" here
+        if (path.startswith("/api/") and not path.endswith(("/download", "/chat/batch"))
+                and encoding_weight(accepted_encodings(Headers(scope=scope).get("accept-encoding", "")), "gzip") > 0):
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+if __name__ == "__main__":
+    # Used by build_executable.py after 'npm run build'
+    target = sys.argv[1] if len(sys.argv) > 1 else "dist"
+    print(f"Precompressed {precompress_directory(target)} files in {target}.")
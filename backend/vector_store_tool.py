@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+
+from vector_stores import ChromaBackend, MmapBackend
+from partitions import PartitionRouter
+
+# Maintenance helper for the vector store backends.
+#   python vector_store_tool.py import   - copy the Chroma collection into the mmap index
+#   python vector_store_tool.py bench    - compare query latency, memory and disk size of both backends
+#   python vector_store_tool.py migrate-partitions - move session documents into per-session partitions
+# Run it from the directory the server runs in (chroma_data/ and vector_index/ live there).
+
+
+class DummyEmbeddings:
+    """Stored vectors are reused as queries, so no embedding provider (or API key) is needed."""
+    def embed_documents(self, texts): return [[]] * len(texts)
+    def embed_query(self, text): return []
+
+
+def rss_mb():
+    """Current resident set size in MB (None where it can't be read)."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def open_backend(name, base_dir, quantize=False):
+    if name == "chroma":
+        return ChromaBackend(DummyEmbeddings(), os.path.join(base_dir, "chroma_data"))
+    return MmapBackend(DummyEmbeddings(), os.path.join(base_dir, "vector_index"), quantize=quantize)
+
+
+def import_chroma(args):
+    chroma = open_backend("chroma", args.dir)
+    target = open_backend("mmap", args.dir, quantize=args.int8)
+    if target.count() and not args.force:
+        print(f"vector_index already holds {target.count()} vectors. Use --force to append anyway.")
+        return 1
+    start = time.perf_counter()
+    total = target.import_from(chroma)
+    print(f"Imported {total} vectors in {time.perf_counter() - start:.1f}s ({target.disk_size() / 1e6:.1f} MB on disk).")
+    return 0
+
+
+def migrate_partitions(args):
+    router = PartitionRouter(DummyEmbeddings(), os.path.join(args.dir, "chroma_data"), mode="session")
+    result = router.migrate()
+    print(f"Moved {result['chunks']} chunks into {result['sessions']} session partitions.")
+    return 0
+
+
+def bench_backend(name, args):
+    before = rss_mb()
+    start = time.perf_counter()
+    backend = open_backend(name, args.dir)
+    open_seconds = time.perf_counter() - start
+    count = backend.count()
+    if not count:
+        print(f"{name}: empty, skipped.")
+        return
+
+    queries = backend.get_all(include_embeddings=True)["embeddings"][:args.queries]
+    session_ids = [m.get("session_id") for m in backend.get_all(include_documents=False)["metadatas"] if m.get("session_id")]
+    search_filter = {"session_id": session_ids[0]} if args.filtered and session_ids else None
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        backend.similarity_search_by_vector(query, k=args.k, filter=search_filter)
+        latencies.append((time.perf_counter() - start) * 1000)
+    after = rss_mb()
+
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f"--- {name} ({count} vectors{', filtered' if search_filter else ''}) ---")
+    print(f"Open:        {open_seconds * 1000:.1f} ms")
+    print(f"Query p50:   {statistics.median(latencies):.2f} ms")
+    print(f"Query p95:   {p95:.2f} ms")
+    if before is not None and after is not None:
+        print(f"RAM delta:   {after - before:.1f} MB")
+    print(f"Disk size:   {backend.disk_size() / 1e6:.1f} MB")
+
+
+def bench(args):
+    for name in args.backends:
+        bench_backend(name, args)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FreeGPT vector store maintenance")
+    parser.add_argument("--dir", default=os.getcwd(), help="Directory containing chroma_data/ and vector_index/")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_import = sub.add_parser("import", help="Copy the Chroma collection into the mmap index")
+    p_import.add_argument("--int8", action="store_true", help="Store int8-quantised vectors")
+    p_import.add_argument("--force", action="store_true", help="Append even if the index is not empty")
+    p_import.set_defaults(func=import_chroma)
+
+    p_bench = sub.add_parser("bench", help="Compare backends on query latency, RAM and disk size")
+    p_bench.add_argument("--backends", nargs="+", default=["chroma", "mmap"], choices=["chroma", "mmap"])
+    p_bench.add_argument("--queries", type=int, default=200)
+    p_bench.add_argument("-k", type=int, default=5)
+    p_bench.add_argument("--filtered", action="store_true", help="Restrict queries to one session_id")
+    p_bench.set_defaults(func=bench)
+
+    p_migrate = sub.add_parser("migrate-partitions", help="Move session documents into per-session partitions")
+    p_migrate.set_defaults(func=migrate_partitions)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,880 @@
+import os
+import json
+import shutil
+import threading
+import importlib.util
+
+import numpy as np
+from langchain_community.vectorstores import Chroma
+from langchain_core.documents import Document
+
+from workers import WORKERS, FileLock, chroma_server_address
+
+# Vector store backends behind RAGEngine.
+# 'chroma' wraps the LangChain Chroma store (default, existing data lives there).
+# 'mmap' keeps embeddings in a memory-mapped float32 (or int8) matrix with a JSONL metadata
+# sidecar and searches it in-process with NumPy, optionally through an HNSW index.
+# Both can be shared by several worker processes: Chroma through a Chroma server
+# (FREEGPT_CHROMA_URL), the mmap index through a writer lock file next to its directory.
+
+BACKEND = os.getenv("FREEGPT_VECTOR_BACKEND", "chroma").lower()
+MMAP_QUANTIZE = os.getenv("FREEGPT_MMAP_QUANTIZE", "").lower() == "int8"
+MMAP_ANN = os.getenv("FREEGPT_MMAP_ANN", "").lower() in ("1", "true", "yes") and importlib.util.find_spec("hnswlib") is not None
+ANN_MIN_ROWS = int(os.getenv("FREEGPT_MMAP_ANN_MIN_ROWS", "20000"))
+
+COLLECTION_NAME = "my_knowledge_base"
+# Session partitions of the mmap backend, next to vector_index/
+MMAP_PARTITIONS_DIR = "vector_index_partitions"
+SEARCH_BLOCK_ROWS = 65536
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class VectorStoreBackend:
+    """Storage and retrieval interface used by RAGEngine."""
+
+    name = "base"
+
+    def add_documents(self, documents) -> int:
+        raise NotImplementedError
+
+    def add_embedded(self, ids, embeddings, texts, metadatas) -> int:
+        """Adds rows whose embeddings were computed elsewhere (imports, migrations, bulk ingestion)."""
+        raise NotImplementedError
+
+    def similarity_search(self, query: str, k: int = 5, filter: dict = None):
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k=k, filter=filter)
+
+    def similarity_search_by_vector(self, embedding, k: int = 5, filter: dict = None):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k, filter=filter)]
+
+    def similarity_search_with_score_by_vector(self, embedding, k: int = 5, filter: dict = None):
+        """Returns (Document, score) pairs, higher score meaning more similar."""
+        raise NotImplementedError
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k: int = 5, filter: dict = None):
+        """One list of (Document, score) pairs per query embedding."""
+        return [self.similarity_search_with_score_by_vector(embedding, k=k, filter=filter) for embedding in embeddings]
+
+    def get_all(self, include_embeddings: bool = False, where: dict = None, include_documents: bool = True) -> dict:
+        """Returns {"ids", "metadatas"[, "documents"][, "embeddings"]} like Chroma's get()."""
+        raise NotImplementedError
+
+    def list_sources(self):
+        sources = set()
+        for metadata in self.get_all(include_documents=False)["metadatas"]:
+            if metadata and "source" in metadata:
+                sources.add(metadata["source"])
+        return list(sources)
+
+    def delete(self, where: dict = None, ids=None) -> int:
+        """Deletes rows matching the metadata filter and/or with the given ids; returns how many."""
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def disk_size(self) -> int:
+        raise NotImplementedError
+
+    def drop(self):
+        """Removes the whole store (used for session partitions)."""
+        raise NotImplementedError
+
+    def get_embedding_model(self):
+        """The embedding model id the stored vectors were built with (None if never recorded)."""
+        raise NotImplementedError
+
+    def set_embedding_model(self, model_id: str):
+        raise NotImplementedError
+
+
+class ChromaBackend(VectorStoreBackend):
+    name = "chroma"
+
+    def __init__(self, embeddings, persist_directory: str, collection_name: str = COLLECTION_NAME):
+        self.embeddings = embeddings
+        self.persist_directory = persist_directory
+        client = _chroma_client()
+        if client is not None:
+            # The server owns persist_directory; this process only talks to it
+            self.store = Chroma(client=client, embedding_function=embeddings, collection_name=collection_name)
+            return
+        self.store = Chroma(
+            persist_directory=persist_directory,
+            embedding_function=embeddings,
+            collection_name=collection_name
+        )
+
+    def add_documents(self, documents) -> int:
+        self.store.add_documents(documents)
+        # Try to force persist if method exists (older versions)
+        if hasattr(self.store, 'persist'):
+            self.store.persist()
+        return len(documents)
+
+    def add_embedded(self, ids, embeddings, texts, metadatas) -> int:
+        self.store._collection.upsert(
+            ids=list(ids),
+            embeddings=[list(map(float, e)) for e in embeddings],
+            documents=list(texts),
+            metadatas=list(metadatas)
+        )
+        return len(ids)
+
+    def similarity_search(self, query: str, k: int = 5, filter: dict = None):
+        return self.store.similarity_search(query, k=k, filter=filter)
+
+    def similarity_search_by_vector(self, embedding, k: int = 5, filter: dict = None):
+        return self.store.similarity_search_by_vector(list(map(float, embedding)), k=k, filter=filter)
+
+    def similarity_search_with_score_by_vector(self, embedding, k: int = 5, filter: dict = None):
+        # Chroma reports distances (lower is closer); negate so scores sort like similarities
+        results = self.store.similarity_search_by_vector_with_relevance_scores(list(map(float, embedding)), k=k, filter=filter)
+        return [(doc, -distance) for doc, distance in results]
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k: int = 5, filter: dict = None):
+        # One query call for the whole batch
+        results = self.store._collection.query(
+            query_embeddings=[list(map(float, e)) for e in embeddings],
+            n_results=k,
+            where=filter,
+            include=["documents", "metadatas", "distances"]
+        )
+        return [
+            [
+                (Document(page_content=text or "", metadata=metadata or {}), -distance)
+                for text, metadata, distance in zip(texts, metadatas, distances)
+            ]
+            for texts, metadatas, distances in zip(results["documents"], results["metadatas"], results["distances"])
+        ]
+
+    def get_all(self, include_embeddings: bool = False, where: dict = None, include_documents: bool = True) -> dict:
+        include = ["metadatas"] + (["documents"] if include_documents else []) + (["embeddings"] if include_embeddings else [])
+        return self.store._collection.get(where=where, include=include)
+
+    def delete(self, where: dict = None, ids=None) -> int:
+        # Using the underlying collection to be safe and efficient
+        collection = self.store._collection
+        matched = collection.get(ids=list(ids) if ids is not None else None, where=where, include=[])["ids"]
+        if matched:
+            collection.delete(ids=matched)
+        return len(matched)
+
+    def count(self) -> int:
+        return self.store._collection.count()
+
+    def disk_size(self) -> int:
+        return directory_size(self.persist_directory)
+
+    def drop(self):
+        self.store.delete_collection()
+
+    def get_embedding_model(self):
+        return (self.store._collection.metadata or {}).get("embedding_model")
+
+    def set_embedding_model(self, model_id: str):
+        # hnsw:* settings can't be modified after creation, so leave them out
+        metadata = {k: v for k, v in (self.store._collection.metadata or {}).items() if not k.startswith("hnsw:")}
+        metadata["embedding_model"] = model_id
+        self.store._collection.modify(metadata=metadata)
+
+
+class MmapBackend(VectorStoreBackend):
+    """Memory-mapped embedding matrix with a JSONL metadata sidecar.
+
+    Layout of the directory:
+      header.json     - dim, row count, dtype, embedding model id
+      vectors.bin     - row-major unit-normalised float32 (or int8) embeddings
+      scales.bin      - per-row float32 dequantisation scale (int8 only)
+      deleted.bin     - one tombstone byte per row
+      metadata.jsonl  - one {"id", "metadata", "text"} line per row
+    The header is rewritten last, so rows past its count (from an interrupted write) are discarded on load.
+    """
+
+    name = "mmap"
+
+    def __init__(self, embeddings, directory: str, quantize: bool = MMAP_QUANTIZE, ann: bool = MMAP_ANN):
+        self.embeddings = embeddings
+        self.directory = directory
+        self.ann = ann
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+
+        self._header_path = os.path.join(directory, "header.json")
+        self._vectors_path = os.path.join(directory, "vectors.bin")
+        self._scales_path = os.path.join(directory, "scales.bin")
+        self._deleted_path = os.path.join(directory, "deleted.bin")
+        self._meta_path = os.path.join(directory, "metadata.jsonl")
+        self._hnsw_path = os.path.join(directory, "hnsw.bin")
+
+        # Writers (in any process) hold this lock; readers never take it
+        self._file_lock = FileLock(os.path.normpath(directory) + ".lock")
+        self._compact_lock = FileLock(os.path.normpath(directory) + ".compact.lock")
+        self._dtype = "int8" if quantize else "float32"
+        self._header_stamp = None
+        self._meta_file = None
+        self._meta_end = 0
+
+        with self._file_lock:
+            if os.path.exists(self._header_path + ".compact"):
+                self._recover_compaction()
+            elif os.path.exists(self._meta_path + ".compact") and self._compact_lock.acquire(blocking=False):
+                # Leftovers of a compaction no process is running any more
+                try:
+                    self._recover_compaction()
+                finally:
+                    self._compact_lock.release()
+            self._reload()
+
+    # --- Loading ---
+
+    def _row_bytes(self):
+        return self.header["dim"] * (1 if self.quantized else 4)
+
+    def _truncate(self, path, size):
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    @staticmethod
+    def _stamp(stat):
+        # header.json is only ever replaced, so a new inode or mtime means another write
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _read_header(self):
+        try:
+            with open(self._header_path, "r", encoding="utf-8") as f:
+                return json.load(f), self._stamp(os.fstat(f.fileno()))
+        except FileNotFoundError:
+            return None, None
+
+    def _reload(self):
+        """Loads the index from disk from scratch."""
+        with self._file_lock:
+            header, stamp = self._read_header()
+            self.header = header or {"version": 1, "dim": None, "count": 0, "dtype": self._dtype}
+            self._header_stamp = stamp
+            self.quantized = self.header["dtype"] == "int8"
+            self.vectors = self.scales = self.deleted = None
+            self._load()
+
+    def _load(self):
+        # Called with the writer lock held, so no append is in progress while tails are truncated
+        count = self.header["count"]
+        self.ids = []
+        self.metadatas = []
+        self._offsets = []
+        self._meta_end = 0
+        self._index = None
+        self._columns = {}
+
+        self._close_meta()
+        if os.path.exists(self._meta_path):
+            self._meta_file = open(self._meta_path, "rb")
+            self._read_rows(count)
+
+        if len(self.ids) != count:
+            print(f"Warning: Vector index metadata has {len(self.ids)} rows, header says {count}. Using {len(self.ids)}.")
+            count = self.header["count"] = len(self.ids)
+
+        self._truncate_tails()
+        self._remap()
+
+    def _read_rows(self, count):
+        """Reads metadata lines after the last known row until there are count rows."""
+        f = self._meta_file
+        f.seek(self._meta_end)
+        while len(self.ids) < count:
+            offset = f.tell()
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                break
+            row = json.loads(line)
+            self.ids.append(row["id"])
+            self.metadatas.append(row.get("metadata") or {})
+            self._offsets.append(offset)
+            self._meta_end = f.tell()
+
+    def _truncate_tails(self):
+        """Drops the tail of any append that was interrupted before the header was rewritten."""
+        count = self.header["count"]
+        row_bytes = self._row_bytes() if self.header["dim"] else 0
+        self._truncate(self._meta_path, self._meta_end)
+        self._truncate(self._vectors_path, count * row_bytes)
+        self._truncate(self._deleted_path, count)
+        self._truncate(self._scales_path, count * 4)
+
+    def _refresh(self):
+        """Picks up what other processes wrote since this one last looked at the header.
+
+        Appended rows are read incrementally; a compaction or drop elsewhere (row numbers changed)
+        means a full reload. Tombstones need nothing: deleted.bin is mapped shared.
+        """
+        try:
+            stamp = self._stamp(os.stat(self._header_path))
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self._header_stamp:
+            return
+        header, stamp = self._read_header()
+        if header is None or header.get("generation", 0) != self.header.get("generation", 0) or header["count"] < self.header["count"]:
+            self._reload()
+            return
+
+        start = self.header["count"]
+        self.header = header
+        self._header_stamp = stamp
+        if header["count"] == start:
+            return
+        if self._meta_file is None:
+            self._meta_file = open(self._meta_path, "rb")
+        self._read_rows(header["count"])
+        if len(self.ids) != header["count"]:
+            self._reload()
+            return
+        self._columns = {}
+        self._remap()
+        if self._index is not None:
+            self._index_add(start, header["count"])
+
+    def _remap(self):
+        count, dim = self.header["count"], self.header["dim"]
+        if not count or not dim:
+            self.vectors = np.zeros((0, dim or 0), dtype=np.int8 if self.quantized else np.float32)
+            self.scales = np.zeros(0, dtype=np.float32)
+            self.deleted = np.zeros(0, dtype=np.uint8)
+            return
+        dtype = np.int8 if self.quantized else np.float32
+        self.vectors = np.memmap(self._vectors_path, dtype=dtype, mode="r", shape=(count, dim))
+        self.scales = np.memmap(self._scales_path, dtype=np.float32, mode="r", shape=(count,)) if self.quantized else None
+        self.deleted = np.memmap(self._deleted_path, dtype=np.uint8, mode="r+", shape=(count,))
+        self._columns = {}
+
+    def _write_header(self):
+        tmp = self._header_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.header, f)
+        os.replace(tmp, self._header_path)
+        self._header_stamp = self._stamp(os.stat(self._header_path))
+
+    # --- Writing ---
+
+    def _encode(self, embeddings):
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.maximum(norms, 1e-12)
+        if not self.quantized:
+            return matrix, None
+        scales = np.maximum(np.abs(matrix).max(axis=1), 1e-12) / 127.0
+        quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+
+    def add_documents(self, documents) -> int:
+        if not documents:
+            return 0
+        texts = [doc.page_content for doc in documents]
+        embeddings = self.embeddings.embed_documents(texts)
+        ids = [doc.metadata.get("id") or os.urandom(16).hex() for doc in documents]
+        return self.add_embedded(ids, embeddings, texts, [doc.metadata for doc in documents])
+
+    def add_embedded(self, ids, embeddings, texts, metadatas) -> int:
+        if len(ids) == 0:
+            return 0
+        with self._lock, self._file_lock:
+            self._refresh()
+            # Dropped by another process meanwhile, or a writer there died mid-append
+            os.makedirs(self.directory, exist_ok=True)
+            self._truncate_tails()
+            rows, scales = self._encode(embeddings)
+            if self.header["dim"] is None:
+                self.header["dim"] = int(rows.shape[1])
+            elif rows.shape[1] != self.header["dim"]:
+                raise ValueError(f"Embedding dimension {rows.shape[1]} does not match index dimension {self.header['dim']}")
+
+            with open(self._vectors_path, "ab") as f:
+                f.write(rows.tobytes())
+            if scales is not None:
+                with open(self._scales_path, "ab") as f:
+                    f.write(scales.tobytes())
+            with open(self._deleted_path, "ab") as f:
+                f.write(bytes(len(ids)))
+
+            offset = self._meta_end
+            offsets = []
+            with open(self._meta_path, "ab") as f:
+                for id_, text, metadata in zip(ids, texts, metadatas):
+                    line = (json.dumps({"id": id_, "metadata": metadata or {}, "text": text}) + "\n").encode("utf-8")
+                    f.write(line)
+                    offsets.append(offset)
+                    offset += len(line)
+
+            start = self.header["count"]
+            self.header["count"] += len(ids)
+            self._write_header()
+
+            self.ids.extend(ids)
+            self.metadatas.extend(metadata or {} for metadata in metadatas)
+            self._offsets.extend(offsets)
+            self._meta_end = offset
+            if self._meta_file is None:
+                self._meta_file = open(self._meta_path, "rb")
+            self._remap()
+            if self._index is not None:
+                self._index_add(start, self.header["count"])
+        return len(ids)
+
+    def delete(self, where: dict = None, ids=None) -> int:
+        with self._lock, self._file_lock:
+            self._refresh()
+            mask = self._filter_mask(where)
+            if ids is not None:
+                wanted = set(ids)
+                mask &= np.fromiter((id_ in wanted for id_ in self.ids), dtype=bool, count=len(self.ids))
+            rows = np.nonzero(mask)[0]
+            if len(rows) == 0:
+                return 0
+            self.deleted[rows] = 1
+            self.deleted.flush()
+            if self._index is not None:
+                for row in rows:
+                    self._index.mark_deleted(int(row))
+            return len(rows)
+
+    # --- Reading ---
+
+    def _column(self, key):
+        if key not in self._columns:
+            self._columns[key] = np.array([m.get(key) for m in self.metadatas], dtype=object)
+        return self._columns[key]
+
+    def _filter_mask(self, where: dict):
+        """Pre-filters rows with vectorised equality over metadata columns."""
+        mask = self.deleted == 0
+        if not where:
+            return mask
+        for key, value in where.items():
+            if key == "$and":
+                for clause in value:
+                    mask &= self._filter_mask(clause)
+            else:
+                if isinstance(value, dict) and "$eq" in value:
+                    value = value["$eq"]
+                mask &= self._column(key) == value
+        return mask
+
+    def _text(self, row: int) -> str:
+        # The handle opened at load keeps reading the same file even if a compaction elsewhere replaces it
+        self._meta_file.seek(self._offsets[row])
+        return json.loads(self._meta_file.readline())["text"]
+
+    def _scores(self, rows, query):
+        """Cosine scores of query against the given rows, computed block by block to bound memory."""
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), SEARCH_BLOCK_ROWS):
+            block = rows[start:start + SEARCH_BLOCK_ROWS]
+            vectors = self.vectors[block]
+            if self.quantized:
+                scores[start:start + len(block)] = (vectors.astype(np.float32) @ query) * self.scales[block]
+            else:
+                scores[start:start + len(block)] = vectors @ query
+        return scores
+
+    def _exact_search(self, query, mask, k):
+        rows = np.nonzero(mask)[0]
+        if len(rows) == 0:
+            return []
+        scores = self._scores(rows, query)
+        if len(rows) > k:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(rows))
+        top = top[np.argsort(-scores[top])]
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+    def _exact_search_many(self, queries, mask, k):
+        """Top k rows for every query, scoring row blocks against all queries with one matrix product."""
+        rows = np.nonzero(mask)[0]
+        if len(rows) == 0:
+            return [[] for _ in queries]
+        # Keep a block's score matrix around SEARCH_BLOCK_ROWS * 16 floats however many queries there are
+        block_rows = max(256, min(SEARCH_BLOCK_ROWS, SEARCH_BLOCK_ROWS * 16 // len(queries)))
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(rows), block_rows):
+            block = rows[start:start + block_rows]
+            vectors = self.vectors[block]
+            if self.quantized:
+                scores = (vectors.astype(np.float32) @ queries.T) * self.scales[block][:, None]
+            else:
+                scores = vectors @ queries.T
+            best_scores = np.concatenate([best_scores, scores.T], axis=1)
+            best_rows = np.concatenate([best_rows, np.broadcast_to(block, (len(queries), len(block)))], axis=1)
+            if best_scores.shape[1] > k:
+                top = np.argpartition(-best_scores, k, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, top, axis=1)
+                best_rows = np.take_along_axis(best_rows, top, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return [
+            [(int(row), float(score)) for row, score in zip(query_rows, query_scores)]
+            for query_rows, query_scores in zip(best_rows, best_scores)
+        ]
+
+    # --- Optional HNSW index ---
+
+    def _dequantize(self, start, end):
+        block = np.asarray(self.vectors[start:end], dtype=np.float32)
+        if self.quantized:
+            block *= self.scales[start:end, None]
+        return block
+
+    def _index_add(self, start, end):
+        self._index.resize_index(max(end, self._index.get_max_elements()))
+        for block_start in range(start, end, SEARCH_BLOCK_ROWS):
+            block_end = min(end, block_start + SEARCH_BLOCK_ROWS)
+            self._index.add_items(self._dequantize(block_start, block_end), np.arange(block_start, block_end))
+
+    def _ensure_index(self):
+        if self._index is not None or not self.ann or self.header["count"] < ANN_MIN_ROWS:
+            return self._index
+        import hnswlib
+
+        count, dim = self.header["count"], self.header["dim"]
+        index = hnswlib.Index(space="ip", dim=dim)
+        if os.path.exists(self._hnsw_path) and self.header.get("hnsw_count") == count:
+            index.load_index(self._hnsw_path, max_elements=count)
+            self._index = index
+        else:
+            print(f"DEBUG: Building HNSW index over {count} vectors...")
+            index.init_index(max_elements=count, ef_construction=200, M=16)
+            self._index = index
+            self._index_add(0, count)
+            for row in np.nonzero(self.deleted)[0]:
+                index.mark_deleted(int(row))
+            self._save_index(count)
+        if self._index is not None:
+            self._index.set_ef(64)
+        return self._index
+
+    def _save_index(self, count):
+        """Persists the HNSW graph unless another process changed the index while it was built."""
+        with self._file_lock:
+            self._refresh()
+            if self._index is None or self.header["count"] != count:
+                return
+            tmp = f"{self._hnsw_path}.{os.getpid()}.tmp"
+            self._index.save_index(tmp)
+            os.replace(tmp, self._hnsw_path)
+            self.header["hnsw_count"] = count
+            self._write_header()
+
+    def _ann_search(self, index, query, mask, k):
+        allowed = int(mask.sum())
+        if allowed == 0:
+            return []
+        try:
+            labels, distances = index.knn_query(query, k=min(k, allowed), filter=lambda label: bool(mask[label]))
+        except RuntimeError:
+            # The graph couldn't reach k allowed neighbours; the exact path always can
+            return self._exact_search(query, mask, k)
+        # hnswlib's "ip" distance is 1 - dot product
+        return [(int(label), float(1.0 - dist)) for label, dist in zip(labels[0], distances[0])]
+
+    def similarity_search_with_score_by_vector(self, embedding, k: int = 5, filter: dict = None):
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        with self._lock:
+            self._refresh()
+            if not self.header["count"]:
+                return []
+            mask = self._filter_mask(filter)
+            index = self._ensure_index()
+            # A selective pre-filter leaves few enough rows that exact search beats graph traversal
+            if index is not None and mask.sum() >= ANN_MIN_ROWS:
+                hits = self._ann_search(index, query, mask, k)
+            else:
+                hits = self._exact_search(query, mask, k)
+            return [
+                (Document(page_content=self._text(row), metadata=dict(self.metadatas[row])), score)
+                for row, score in hits
+            ]
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k: int = 5, filter: dict = None):
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            self._refresh()
+            if not self.header["count"] or not len(queries):
+                return [[] for _ in queries]
+            mask = self._filter_mask(filter)
+            index = self._ensure_index()
+            if index is not None and mask.sum() >= ANN_MIN_ROWS:
+                hits = [self._ann_search(index, query, mask, k) for query in queries]
+            else:
+                hits = self._exact_search_many(queries, mask, k)
+            return [
+                [(Document(page_content=self._text(row), metadata=dict(self.metadatas[row])), score) for row, score in query_hits]
+                for query_hits in hits
+            ]
+
+    def get_all(self, include_embeddings: bool = False, where: dict = None, include_documents: bool = True) -> dict:
+        with self._lock:
+            self._refresh()
+            rows = np.nonzero(self._filter_mask(where))[0] if self.header["count"] else []
+            data = {
+                "ids": [self.ids[row] for row in rows],
+                "metadatas": [self.metadatas[row] for row in rows],
+            }
+            if include_documents:
+                data["documents"] = [self._text(row) for row in rows]
+            if include_embeddings:
+                data["embeddings"] = [self._dequantize(row, row + 1)[0].tolist() for row in rows]
+            return data
+
+    def list_sources(self):
+        with self._lock:
+            self._refresh()
+            live = self.deleted == 0
+            return list({m["source"] for m, alive in zip(self.metadatas, live) if alive and "source" in m})
+
+    def count(self) -> int:
+        with self._lock:
+            self._refresh()
+            return int((self.deleted == 0).sum()) if self.header["count"] else 0
+
+    def disk_size(self) -> int:
+        return directory_size(self.directory)
+
+    def drop(self):
+        with self._lock, self._file_lock:
+            # Release the maps before deleting the files (required on Windows)
+            self.vectors = self.scales = self.deleted = None
+            self._index = None
+            self._close_meta()
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self._reload()
+        with _mmap_stores_lock:
+            _mmap_stores.pop(self.directory, None)
+
+    # --- Compaction ---
+
+    def _close_meta(self):
+        if self._meta_file is not None:
+            self._meta_file.close()
+            self._meta_file = None
+
+    def _data_paths(self):
+        return [self._vectors_path, self._scales_path, self._deleted_path, self._meta_path]
+
+    def _recover_compaction(self):
+        """Finishes a compaction that crashed mid-swap, or discards one that crashed mid-copy.
+
+        The new header is written last and swapped in last, so its presence means every new
+        data file is complete.
+        """
+        if os.path.exists(self._header_path + ".compact"):
+            for path in self._data_paths() + [self._header_path]:
+                if os.path.exists(path + ".compact"):
+                    os.replace(path + ".compact", path)
+            # Row numbers changed; the HNSW graph is rebuilt on demand
+            if os.path.exists(self._hnsw_path):
+                os.remove(self._hnsw_path)
+        else:
+            for path in self._data_paths():
+                if os.path.exists(path + ".compact"):
+                    os.remove(path + ".compact")
+
+    def compact(self) -> int:
+        """Rewrites the index without deleted rows and returns the bytes reclaimed.
+
+        Live rows are copied into .compact files without holding the lock, so searches and writes
+        continue meanwhile; rows added or deleted during the copy are reconciled under the lock
+        just before the files are swapped in. Other processes notice the new generation in the
+        header and reload.
+        """
+        if os.name == "nt" and WORKERS > 1:
+            # The other workers keep the files mapped, and Windows can't replace mapped files
+            print(f"DEBUG: Skipping compaction of {self.directory}: not supported with several workers on Windows.")
+            return 0
+        if not self._compact_lock.acquire(blocking=False):
+            print(f"DEBUG: {self.directory} is already being compacted by another process.")
+            return 0
+        try:
+            return self._compact()
+        finally:
+            self._compact_lock.release()
+
+    def _compact(self) -> int:
+        with self._lock:
+            self._refresh()
+            count = self.header["count"]
+            if not count or not int(np.count_nonzero(self.deleted)):
+                return 0
+            live = np.nonzero(np.array(self.deleted) == 0)[0]
+            vectors, scales = self.vectors, self.scales
+            generation = self.header.get("generation", 0)
+        before = self.disk_size()
+
+        def copy_rows(rows, vectors, scales, mode):
+            with open(self._vectors_path + ".compact", mode) as f:
+                for start in range(0, len(rows), SEARCH_BLOCK_ROWS):
+                    f.write(np.ascontiguousarray(vectors[rows[start:start + SEARCH_BLOCK_ROWS]]).tobytes())
+            if scales is not None:
+                with open(self._scales_path + ".compact", mode) as f:
+                    f.write(np.ascontiguousarray(scales[rows]).tobytes())
+            with open(self._meta_path, "rb") as source, open(self._meta_path + ".compact", mode) as f:
+                for row in rows:
+                    source.seek(self._offsets[row])
+                    f.write(source.readline())
+
+        copy_rows(live, vectors, scales, "wb")
+
+        with self._lock, self._file_lock:
+            self._refresh()
+            if self.header.get("generation", 0) != generation or self.header["count"] < count:
+                # Dropped by another process during the copy
+                for path in self._data_paths():
+                    if os.path.exists(path + ".compact"):
+                        os.remove(path + ".compact")
+                return 0
+            # Reconcile: append rows added since the snapshot, carry over tombstones set meanwhile
+            added = np.arange(count, self.header["count"])
+            copy_rows(added, self.vectors, self.scales, "ab")
+            with open(self._deleted_path + ".compact", "wb") as f:
+                f.write(np.asarray(self.deleted[live], dtype=np.uint8).tobytes())
+                f.write(np.asarray(self.deleted[count:], dtype=np.uint8).tobytes())
+            header = dict(self.header, count=int(len(live) + len(added)), generation=generation + 1)
+            header.pop("hnsw_count", None)
+            with open(self._header_path + ".compact", "w", encoding="utf-8") as f:
+                json.dump(header, f)
+
+            # Release the maps before replacing the files (required on Windows)
+            self.vectors = self.scales = self.deleted = None
+            self._index = None
+            self._close_meta()
+            self._recover_compaction()
+            self._reload()
+        reclaimed = max(0, before - self.disk_size())
+        print(f"DEBUG: Compacted {self.directory}: {count - len(live)} deleted rows dropped, {reclaimed} bytes reclaimed.")
+        return reclaimed
+
+    def get_embedding_model(self):
+        with self._lock:
+            self._refresh()
+            return self.header.get("embedding_model")
+
+    def set_embedding_model(self, model_id: str):
+        with self._lock, self._file_lock:
+            self._refresh()
+            os.makedirs(self.directory, exist_ok=True)
+            self.header["embedding_model"] = model_id
+            self._write_header()
+
+    def import_from(self, source: VectorStoreBackend, batch_size: int = 1000) -> int:
+        """Copies every row (with its stored embedding) from another backend, e.g. the Chroma collection."""
+        data = source.get_all(include_embeddings=True)
+        total = len(data["ids"])
+        print(f"DEBUG: Importing {total} vectors from {source.name}...")
+        for start in range(0, total, batch_size):
+            end = start + batch_size
+            self.add_embedded(
+                data["ids"][start:end],
+                data["embeddings"][start:end],
+                data["documents"][start:end],
+                data["metadatas"][start:end]
+            )
+        return total
+
+
+_mmap_stores = {}
+_mmap_stores_lock = threading.Lock()
+_chroma_http_client = None
+
+
+def _chroma_client():
+    """HTTP client for the Chroma server when one is configured (shared by all collections), else None."""
+    global _chroma_http_client
+    address = chroma_server_address()
+    if address is None:
+        return None
+    if _chroma_http_client is None:
+        import chromadb
+        host, port, ssl = address
+        _chroma_http_client = chromadb.HttpClient(host=host, port=port, ssl=ssl)
+    return _chroma_http_client
+
+
+def mmap_directory(persist_directory: str, partition: str = None) -> str:
+    # Partitions sit next to the global index rather than inside it, so the global store's
+    # size, compaction and drop() only ever cover its own files
+    base = os.path.dirname(persist_directory)
+    return os.path.join(base, MMAP_PARTITIONS_DIR, partition) if partition else os.path.join(base, "vector_index")
+
+
+def _move_legacy_partitions(index_directory: str):
+    """Partitions used to be kept in vector_index/partitions; moves them to their own directory."""
+    legacy = os.path.join(index_directory, "partitions")
+    if not os.path.isdir(legacy):
+        return
+    target = os.path.join(os.path.dirname(index_directory), MMAP_PARTITIONS_DIR)
+    os.makedirs(target, exist_ok=True)
+    for name in os.listdir(legacy):
+        try:
+            os.replace(os.path.join(legacy, name), os.path.join(target, name))
+        except OSError as e:
+            # Another worker moved it first, or a partition of that name already exists
+            print(f"Warning: Could not move partition {name} out of {legacy}: {e}")
+    try:
+        os.rmdir(legacy)
+    except OSError:
+        pass
+
+
+def chroma_collection_name(partition: str = None) -> str:
+    return f"kb_{partition}" if partition else COLLECTION_NAME
+
+
+def create_vector_store(embeddings, persist_directory: str, backend: str = BACKEND, partition: str = None) -> VectorStoreBackend:
+    """Builds the configured backend for the global store or a named partition.
+
+    Both backends live under the same working directory; partitions are separate Chroma
+    collections or separate index directories.
+    """
+    if backend == "mmap":
+        directory = mmap_directory(persist_directory, partition)
+        if partition is None:
+            _move_legacy_partitions(directory)
+        # One writer object per directory, shared by every engine instance in this process
+        with _mmap_stores_lock:
+            store = _mmap_stores.get(directory)
+            if store is None:
+                store = _mmap_stores[directory] = MmapBackend(embeddings, directory)
+            store.embeddings = embeddings
+        return store
+    if backend != "chroma":
+        print(f"Warning: Unknown vector backend '{backend}', using chroma.")
+    return ChromaBackend(embeddings, persist_directory, collection_name=chroma_collection_name(partition))
+
+
+def list_partitions(global_store: VectorStoreBackend):
+    """Names of the partitions that exist next to the global store (which is not included)."""
+    if isinstance(global_store, MmapBackend):
+        directory = os.path.join(os.path.dirname(global_store.directory), MMAP_PARTITIONS_DIR)
+        if not os.path.isdir(directory):
+            return []
+        return [name for name in os.listdir(directory) if os.path.exists(os.path.join(directory, name, "header.json"))]
+
+    # Reuse the store's own client; a second client with other settings would be refused by Chroma
+    names = [getattr(c, "name", c) for c in global_store.store._client.list_collections()]
+    return [name[3:] for name in names if name.startswith("kb_")]
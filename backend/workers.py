@@ -0,0 +1,189 @@
+import os
+import sys
+import time
+import shutil
+import atexit
+import threading
+import subprocess
+import urllib.request
+from urllib.parse import urlparse
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# Multi-worker deployment support.
+# With FREEGPT_WORKERS > 1 uvicorn runs several server processes. Everything they share lives
+# outside the processes: chats.db (SQLite in WAL mode), the vector store and the small JSON/lock
+# files in the working directory. Chroma is never opened in-process by more than one worker:
+# the workers talk to a Chroma server (FREEGPT_CHROMA_URL, or one started here on
+# FREEGPT_CHROMA_PORT). The mmap index serialises writers with a file lock and readers pick up
+# other workers' writes from its header. Per-process limits (provider budgets) are split
+# between the workers, and singleton jobs (scheduled GC) run in one elected worker only.
+
+WORKERS = max(1, int(os.getenv("FREEGPT_WORKERS", "1")))
+CHROMA_URL = os.getenv("FREEGPT_CHROMA_URL")
+CHROMA_PORT = int(os.getenv("FREEGPT_CHROMA_PORT", "8001"))
+CHROMA_START_TIMEOUT = 60
+
+PRIMARY_LOCK_PATH = os.path.join(os.getcwd(), "freegpt_primary.lock")
+
+
+class FileLock:
+    """Exclusive lock across threads and processes, held on a lock file.
+
+    Re-entrant within a thread, like the RLocks it is used next to.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def _lock_file(self, blocking: bool):
+        fd = self._file.fileno()
+        if os.name != "nt":
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            return
+        # msvcrt's blocking mode gives up after 10 seconds, so poll instead
+        while True:
+            try:
+                self._file.seek(0)
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                return
+            except OSError:
+                if not blocking:
+                    raise
+                time.sleep(0.05)
+
+    def _unlock_file(self):
+        if os.name == "nt":
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if self._depth:
+            self._depth += 1
+            return True
+        try:
+            self._file = open(self.path, "a+b")
+            self._lock_file(blocking)
+        except OSError:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._thread_lock.release()
+            if not blocking:
+                return False
+            raise
+        self._depth = 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if not self._depth:
+            try:
+                self._unlock_file()
+            finally:
+                self._file.close()
+                self._file = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+_primary_lock = FileLock(PRIMARY_LOCK_PATH)
+_is_primary = None
+
+
+def is_primary_worker() -> bool:
+    """True in exactly one worker process (the first to claim it); the claim lasts for the process lifetime."""
+    global _is_primary
+    if _is_primary is None:
+        _is_primary = _primary_lock.acquire(blocking=False)
+    return _is_primary
+
+
+def share_of(limit: int) -> int:
+    """This worker's part of a limit meant for the whole server (0 stays unlimited)."""
+    if limit <= 0 or WORKERS == 1:
+        return limit
+    return max(1, limit // WORKERS)
+
+
+def chroma_server_address(url: str = None):
+    """(host, port, ssl) of the Chroma server the workers use, or None to open chroma_data in-process."""
+    url = url or CHROMA_URL
+    if not url:
+        return None
+    parsed = urlparse(url if "://" in url else f"http://{url}")
+    ssl = parsed.scheme == "https"
+    return parsed.hostname or "localhost", parsed.port or (443 if ssl else 8000), ssl
+
+
+def _chroma_ready(url: str) -> bool:
+    try:
+        with urllib.request.urlopen(f"{url}/api/v2/heartbeat", timeout=2) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+def start_chroma_server(persist_directory: str, port: int = CHROMA_PORT) -> str:
+    """Starts a local Chroma server on persist_directory for the workers and returns its URL.
+
+    The server is stopped when this (the supervising) process exits.
+    """
+    url = f"http://127.0.0.1:{port}"
+    if _chroma_ready(url):
+        print(f"DEBUG: Using the Chroma server already running at {url}.")
+        return url
+
+    chroma = shutil.which("chroma")
+    if chroma:
+        command = [chroma]
+    else:
+        command = [sys.executable, "-c", "import sys; from chromadb.cli.cli import app; sys.argv[0] = 'chroma'; app()"]
+    command += ["run", "--path", persist_directory, "--host", "127.0.0.1", "--port", str(port)]
+    print(f"DEBUG: Starting Chroma server for {persist_directory} on port {port}...")
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    atexit.register(_stop_process, process)
+
+    deadline = time.monotonic() + CHROMA_START_TIMEOUT
+    while not _chroma_ready(url):
+        if process.poll() is not None:
+            raise RuntimeError(f"Chroma server exited with code {process.returncode}; is port {port} free?")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Chroma server did not come up on port {port} within {CHROMA_START_TIMEOUT}s.")
+        time.sleep(0.2)
+    print("DEBUG: Chroma server ready.")
+    return url
+
+
+def _stop_process(process):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def worker_stats():
+    return {
+        "workers": WORKERS,
+        "pid": os.getpid(),
+        "primary": bool(_is_primary),
+        "chroma": CHROMA_URL or "in-process",
+    }
@@ -20,6 +20,8 @@ def main():
     if not os.path.exists("node_modules"):
         run_command("npm install")
     run_command("npm run build")
+    # Ship .gz/.br copies of the bundle so the server never compresses static files at runtime
+    run_command(f'"{sys.executable}" backend/static_files.py dist')
 
     # 3. Prepare Backend for Packing
     # We need to ensure the backend can find the dist folder relative to itself inside the exe
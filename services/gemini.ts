@@ -46,25 +46,35 @@ export const generateResponseStream = async ({
       const backendUrl = `${baseUrl}/api/chat`;
 
       try {
+        const payload = JSON.stringify({
+          message: prompt,
+          model: modelId,
+          apiKey: key, 
+          providerUrl: apiEndpoint, 
+          history: history,
+          deepThink: enableThinking,
+          enableSearch: enableSearch,
+          searchApiKey: searchApiKey,
+          systemInstruction: systemInstruction,
+          sessionId: sessionId
+        });
+
+        // Images go as a binary multipart part instead of a base64 string inside the JSON
+        let requestBody: BodyInit = payload;
+        const headers: Record<string, string> = { 'x-api-key': key };
+        if (image) {
+          const form = new FormData();
+          form.append('payload', payload);
+          form.append('image', await (await fetch(image)).blob(), 'image');
+          requestBody = form;
+        } else {
+          headers['Content-Type'] = 'application/json';
+        }
+
         const response = await fetch(backendUrl, {
           method: 'POST',
-          headers: {
-            'Content-Type': 'application/json',
-            'x-api-key': key 
-          },
-          body: JSON.stringify({
-            message: prompt,
-            image: image,
-            model: modelId,
-            apiKey: key, 
-            providerUrl: apiEndpoint, 
-            history: history,
-            deepThink: enableThinking,
-            enableSearch: enableSearch,
-            searchApiKey: searchApiKey,
-            systemInstruction: systemInstruction,
-            sessionId: sessionId
-          }),
+          headers: headers,
+          body: requestBody,
           signal: signal
         });
 